@@ -8,6 +8,7 @@
   :license: AGPL3, see LICENSE.txt for more details
 """
 
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
 
 import numpy as np
@@ -15,6 +16,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.path import Path
 import matplotlib.patches as patches
+from matplotlib.collections import PathCollection
+from matplotlib.colors import to_rgba
+from matplotlib.text import Text
 
 # ===================
 # = Flow data model =
@@ -34,15 +38,125 @@ class FlowDataSource:
   # returns a DataFrame[step1, node1, step2, node2; size]
   def get_flows(self): 
     raise Exception('Not implemented')
+  
+  # Returns (nodes, sequence, flows). Data sources that can fetch these 
+  # concurrently can override this.
+  def get_all(self):
+    return self.get_nodes(), self.get_sequence(), self.get_flows()
+  
+  # Returns the flow data as a FlowArrays instance. Data sources that can 
+  # decode their data directly into arrays can override this.
+  def get_flow_arrays(self):
+    return FlowArrays.from_frames(*self.get_all())
+
+# Precomputed flow data.
+# nodes: ordered list of node names
+# sequence: DataFrame[step, node; size]
+# flows: DataFrame[step1, node1, step2, node2; size]
+class StaticFlowDataSource(FlowDataSource):
+  def __init__(self, nodes, sequence, flows):
+    self.nodes = nodes
+    self.sequence = sequence
+    self.flows = flows
+  
+  def get_nodes(self):
+    return self.nodes
+  
+  def get_sequence(self): 
+    return self.sequence
+  
+  def get_flows(self): 
+    return self.flows
+
+# Integer-coded flow data, as used by AlluvialFlowLayout.
+# nodes: ordered list of node names
+# steps: sorted steps
+# sequence_size: step -> node -> size array, NaN for missing entries
+# flow_step, flow_node1, flow_node2, flow_size: flows between consecutive steps, 
+#   ordered by step pair, node1, node2. flow_step is the index of step1, and of the step pair.
+class FlowArrays:
+  def __init__(self, nodes, steps, sequence_size, flow_step, flow_node1, flow_node2, flow_size):
+    self.nodes = nodes
+    self.steps = steps
+    self.sequence_size = sequence_size
+    self.flow_step = flow_step
+    self.flow_node1 = flow_node1
+    self.flow_node2 = flow_node2
+    self.flow_size = flow_size
+  
+  # Builds FlowArrays from step/node positions per row, -1 for unknown steps 
+  # or nodes. Skips unknown entries, and flows between non-consecutive steps.
+  @classmethod
+  def from_codes(cls, nodes, steps, 
+           seq_step, seq_node, seq_size, 
+           flow_step1, flow_node1, flow_step2, flow_node2, flow_size):
+    # step -> node -> size, NaN for missing entries
+    sequence_size = np.full((len(steps), len(nodes)), np.nan)
+    valid = (seq_step >= 0) & (seq_node >= 0)
+    sequence_size[seq_step[valid], seq_node[valid]] = \
+      np.asarray(seq_size, dtype=float)[valid]
+    
+    # flows between consecutive steps, ordered by step pair, node1, node2
+    valid = (flow_step1 >= 0) & (flow_step2 == flow_step1 + 1) & \
+      (flow_node1 >= 0) & (flow_node2 >= 0)
+    order = np.lexsort((flow_node2[valid], flow_node1[valid], flow_step1[valid]))
+    return cls(nodes, steps, sequence_size, 
+      flow_step1[valid][order], flow_node1[valid][order], flow_node2[valid][order], 
+      np.asarray(flow_size, dtype=float)[valid][order])
+  
+  # nodes: ordered list of node names
+  # sequence: DataFrame[step, node; size]
+  # flows: DataFrame[step1, node1, step2, node2; size]
+  @classmethod
+  def from_frames(cls, nodes, sequence, flows):
+    steps = sequence.index.levels[0]        # already sorted
+    node_pos = dict(zip(nodes, range(len(nodes))))
+    
+    # index level value -> node/step position, or -1
+    def node_codes(index, level):
+      level_pos = np.array([node_pos.get(node, -1) for node in index.levels[level]], dtype=int)
+      return np.r_[level_pos, -1][index.codes[level]]
+    def step_codes(index, level):
+      level_pos = np.asarray(steps.get_indexer(index.levels[level]), dtype=int)
+      return np.r_[level_pos, -1][index.codes[level]]
+    
+    return cls.from_codes(nodes, steps, 
+      step_codes(sequence.index, 0), node_codes(sequence.index, 1), 
+      sequence['size'].values, 
+      step_codes(flows.index, 0), node_codes(flows.index, 1), 
+      step_codes(flows.index, 2), node_codes(flows.index, 3), 
+      flows['size'].values)
 
 # ==========
 # = Layout =
 # ==========
 
-# TODO: find a more elegant way to skip missing node/flow entries without all these try/except blocks
+# Applies a scaling function to a whole array of weights. Functions that only 
+# accept scalars (e.g. math.log) are vectorised.
+def scale_array(scale_weights, values):
+  values = np.asarray(values, dtype=float)
+  try:
+    scaled = np.asarray(scale_weights(values), dtype=float)
+    if scaled.shape == values.shape:
+      return scaled
+  except (TypeError, ValueError):
+    pass
+  return np.vectorize(scale_weights, otypes=[float])(values)
+
+# Exclusive running sums of values within runs of equal group keys.
+# groups: non-decreasing group keys, one per value
+def group_offsets(groups, values):
+  if len(values)==0:
+    return values
+  cumsum = np.cumsum(values) - values
+  first = np.r_[0, np.flatnonzero(np.diff(groups)) + 1]
+  run_lengths = np.diff(np.r_[first, len(values)])
+  return cumsum - np.repeat(cumsum[first], run_lengths)
+
 class AlluvialFlowLayout:
   # flow_data_source: a FlowDataSource instance
-  # scale_weights: a scaling function for scalars.
+  # scale_weights: a scaling function for scalars. Ideally a numpy ufunc, or 
+  #   anything else that also accepts arrays.
   # compact: adjust vertical node spacing to current flow sizes? Otherwise keep it constant throughout.
   def __init__(self, flow_data_source, 
          node_margin=50, node_width=0.02,
@@ -55,16 +169,65 @@ class AlluvialFlowLayout:
     self.scale_weights = scale_weights
     self.compact = compact
     self.show_stationary_component = show_stationary_component
+    self.__load()
+    self.__layout()
+  
+  # Recomputes the layout with new parameters, without reloading the data.
+  # params: any of node_margin, node_width, scale_weights, compact, show_stationary_component
+  def relayout(self, **params):
+    for name, value in params.items():
+      if name not in ('node_margin', 'node_width', 'scale_weights', 
+                      'compact', 'show_stationary_component'):
+        raise TypeError('Unknown layout parameter: %s' % name)
+      setattr(self, name, value)
     self.__layout()
+    return self
+  
+  # Loads the flow data as integer-coded arrays.
+  def __load(self):
+    arrays = self.flow_data_source.get_flow_arrays()
+    self.nodes = arrays.nodes
+    self.steps = arrays.steps
+    self.sequence_size = arrays.sequence_size # step -> node -> size, NaN for missing entries
+    # flows between consecutive steps, ordered by step pair, node1, node2
+    self.flow_step = arrays.flow_step # index of step1, and of the step pair
+    self.flow_node1 = arrays.flow_node1
+    self.flow_node2 = arrays.flow_node2
+    self.flow_size = arrays.flow_size
+  
+  # Computes node port and edge coordinates for one side of all step pairs.
+  # present, node_size: step pair -> node -> ..., for the steps on this side
+  # flow_node: the node of each flow on this side, flow_other: on the other side
+  # Returns (port y1, port y2, final positions per step pair, edge centres)
+  def __layout_ports(self, present, node_size, node_maxsize, flow_node, flow_other, edge_width):
+    num_pairs, num_nodes = present.shape
+    flow_size = np.bincount(self.flow_step * num_nodes + flow_node, 
+      weights=edge_width, minlength=num_pairs * num_nodes).reshape(num_pairs, num_nodes)
+    if self.show_stationary_component:
+      height = np.where(present, node_size, 0) # "in"/"out" flow
+    else:
+      height = np.where(present, flow_size, 0)
+    if self.compact==False:
+      block = np.repeat(node_maxsize[np.newaxis, :], num_pairs, axis=0)
+    else:
+      block = height
+    block = block + self.node_margin
+    y1 = self.miny + np.cumsum(block, axis=1) - block
+    y2 = y1 + height
+    end = y1[:, -1] + block[:, -1] if num_nodes > 0 else np.full(num_pairs, self.miny)
+    
+    # edges are stacked within each port, in node order of the other side
+    order = np.lexsort((flow_other, flow_node, self.flow_step))
+    offsets = np.empty(len(order))
+    offsets[order] = group_offsets(
+      self.flow_step[order] * num_nodes + flow_node[order], edge_width[order])
+    edge_y = y1[self.flow_step, flow_node] + offsets + edge_width/2.0
+    edge_y[~present[self.flow_step, flow_node]] = np.nan
+    return y1, y2, end, edge_y
   
   def __layout(self):
-    nodes = self.flow_data_source.get_nodes()     # ordered list of node names
-    sequence = self.flow_data_source.get_sequence() # DataFrame[step, node; size]
-    steps = sequence.index.levels[0]        # already sorted
-    flows = self.flow_data_source.get_flows()     # DataFrame[step1, node1, step2, node2; size]
-
-    self.nodes = nodes
-    self.steps = steps
+    steps = self.steps
+    nodes = self.nodes
     
     self.minx = 0
     self.maxx = len(steps) - 1 + 0.3
@@ -73,24 +236,46 @@ class AlluvialFlowLayout:
     
     # step -> x
     self.step_x = dict(zip(steps, range(len(steps))))
-
+    
+    # scaled sizes
+    present = ~np.isnan(self.sequence_size)
+    node_size = np.zeros(self.sequence_size.shape)
+    node_size[present] = scale_array(self.scale_weights, self.sequence_size[present])
+    self.edge_width = scale_array(self.scale_weights, self.flow_size)
+    node_maxsize = np.where(present, node_size, 0).max(axis=0) if len(steps) > 0 \
+      else np.zeros(len(nodes))
+    
+    # step pair -> node -> y1/y2, and edge -> y-centre, NaN for unplaced edges
+    self.src_y1, self.src_y2, src_end, self.edge_y1 = self.__layout_ports(
+      present[:-1], node_size[:-1], node_maxsize, 
+      self.flow_node1, self.flow_node2, self.edge_width) # source
+    self.dst_y1, self.dst_y2, dst_end, self.edge_y2 = self.__layout_ports(
+      present[1:], node_size[1:], node_maxsize, 
+      self.flow_node2, self.flow_node1, self.edge_width) # destination
+    self.maxy = max([self.maxy] + src_end.tolist() + dst_end.tolist())
+    
+    # node -> size
+    if self.compact==False:
+      self.node_maxsize = defaultdict(lambda: 0, zip(nodes, node_maxsize.tolist()))
+    
+    self.build_lookups()
+  
+  # Builds the step/node dicts used for plotting from the layout arrays: 
+  # src_y1/y2, dst_y1/y2, flow_step/node1/node2, edge_width, edge_y1/y2.
+  def build_lookups(self):
+    steps = list(self.steps)
+    nodes = self.nodes
+    
     # step -> node -> y1/y2
     self.node1_y1 = defaultdict(lambda: dict())
     self.node1_y2 = defaultdict(lambda: dict())
     self.node2_y1 = defaultdict(lambda: dict())
     self.node2_y2 = defaultdict(lambda: dict())
-
-    # node -> size
-    if self.compact==False:
-      self.node_maxsize = defaultdict(lambda: 0)
-      for step in steps:
-        for node1 in nodes:
-          try:
-            node = sequence.loc[step, node1]
-            node_size = self.scale_weights(node['size'])
-            self.node_maxsize[node1] = max(self.node_maxsize[node1], node_size)
-          except KeyError:
-            pass
+    for idx, (step1, step2) in enumerate(zip(steps[:-1], steps[1:])):
+      self.node1_y1[step1] = dict(zip(nodes, self.src_y1[idx].tolist()))
+      self.node1_y2[step1] = dict(zip(nodes, self.src_y2[idx].tolist()))
+      self.node2_y1[step2] = dict(zip(nodes, self.dst_y1[idx].tolist()))
+      self.node2_y2[step2] = dict(zip(nodes, self.dst_y2[idx].tolist()))
 
     # step -> node1 -> node2 -> y-center
     self.edge_node1_y = defaultdict(lambda: defaultdict(lambda: dict())) # source
@@ -98,74 +283,302 @@ class AlluvialFlowLayout:
 
     # step -> node1 -> node2 -> size
     self.edge_size = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: 0))) # edge
+    
+    for idx, node1, node2, size, y1, y2 in zip(self.flow_step.tolist(), 
+        self.flow_node1.tolist(), self.flow_node2.tolist(), 
+        self.edge_width.tolist(), self.edge_y1.tolist(), self.edge_y2.tolist()):
+      step1, step2 = steps[idx], steps[idx + 1]
+      node1, node2 = nodes[node1], nodes[node2]
+      self.edge_size[step1][node1][node2] = size
+      if y1==y1: # not NaN
+        self.edge_node1_y[step1][node1][node2] = y1
+      if y2==y2:
+        self.edge_node2_y[step2][node1][node2] = y2
+
+  
+  # Sets the same step/node lookups as build_lookups(), but as read-only views 
+  # over the layout arrays, so it does no per-flow work. Edges must be ordered 
+  # by step pair, node1, node2.
+  # keys: edge keys as returned by edge_keys(), if already computed
+  def build_views(self, keys=None):
+    steps = list(self.steps)
+    num_nodes = len(self.nodes)
+    if keys is None:
+      keys = edge_keys(self.flow_step, self.flow_node1, self.flow_node2, num_nodes)
+    
+    # step1/step2 -> step pair index, node -> index
+    step1_pos = dict(zip(steps[:-1], range(len(steps) - 1)))
+    step2_pos = dict(zip(steps[1:], range(len(steps) - 1)))
+    node_pos = dict(zip(self.nodes, range(num_nodes)))
+    
+    # step -> node -> y1/y2
+    port = lambda values: lambda idx, node: float(values[idx, node])
+    self.node1_y1 = ArrayView(port(self.src_y1), [step1_pos, node_pos])
+    self.node1_y2 = ArrayView(port(self.src_y2), [step1_pos, node_pos])
+    self.node2_y1 = ArrayView(port(self.dst_y1), [step2_pos, node_pos])
+    self.node2_y2 = ArrayView(port(self.dst_y2), [step2_pos, node_pos])
+    
+    # step -> node1 -> node2 -> y-center/size
+    def edge(values, missing=None):
+      def lookup(idx, node1, node2):
+        key = (idx * num_nodes + node1) * num_nodes + node2
+        pos = np.searchsorted(keys, key)
+        if pos < len(keys) and keys[pos]==key:
+          value = float(values[pos])
+          if missing is not None or value==value: # not NaN
+            return value
+        if missing is None:
+          raise KeyError((idx, node1, node2))
+        return missing
+      return lookup
+    def present(values, skip_nan):
+      def node2s(idx, node1):
+        first = (idx * num_nodes + node1) * num_nodes
+        start, end = np.searchsorted(keys, [first, first + num_nodes])
+        nodes = keys[start:end] % num_nodes
+        if skip_nan:
+          nodes = nodes[~np.isnan(values[start:end])]
+        return [self.nodes[node] for node in nodes]
+      return node2s
+    self.edge_node1_y = ArrayView(edge(self.edge_y1), [step1_pos, node_pos, node_pos], 
+      present(self.edge_y1, True)) # source
+    self.edge_node2_y = ArrayView(edge(self.edge_y2), [step2_pos, node_pos, node_pos], 
+      present(self.edge_y2, True)) # destination
+    self.edge_size = ArrayView(edge(self.edge_width, 0), [step1_pos, node_pos, node_pos], 
+      present(self.edge_width, False)) # edge
+
+# Sort keys for edges, in order of step pair, node1, node2.
+def edge_keys(flow_step, flow_node1, flow_node2, num_nodes):
+  flow_step, flow_node1, flow_node2 = [np.asarray(values, dtype=np.int64) 
+    for values in (flow_step, flow_node1, flow_node2)]
+  return (flow_step * num_nodes + flow_node1) * num_nodes + flow_node2
+
+# Nested dict-like lookups over layout arrays, e.g. view[step][node].
+# lookup: a function that takes one index per level and returns a value, or 
+#   raises KeyError
+# key_maps: one dict per level that maps keys to array indices
+# present: optional function that takes the indices of all but the last level, 
+#   and returns the keys present in the last level. Defaults to all keys.
+class ArrayView:
+  def __init__(self, lookup, key_maps, present=None, prefix=()):
+    self.lookup = lookup
+    self.key_maps = key_maps
+    self.present = present
+    self.prefix = prefix
+  
+  def __getitem__(self, key):
+    prefix = self.prefix + (self.key_maps[len(self.prefix)][key],)
+    if len(prefix)==len(self.key_maps):
+      return self.lookup(*prefix)
+    return ArrayView(self.lookup, self.key_maps, self.present, prefix)
+  
+  def keys(self):
+    if self.present is not None and len(self.prefix)==len(self.key_maps) - 1:
+      return self.present(*self.prefix)
+    return list(self.key_maps[len(self.prefix)].keys())
+  
+  def __contains__(self, key):
+    return key in self.keys()
+  
+  def __iter__(self):
+    return iter(self.keys())
+  
+  def __len__(self):
+    return len(self.keys())
+  
+  def items(self):
+    return [(key, self[key]) for key in self.keys()]
+
+
+# ===============
+# = Hit testing =
+# ===============
+
+# Bezier parameter t at which horiz_flow_path(x1, .., x2, .., curve) reaches x. 
+# x(t) is monotonic for curve in 0..1, so this bisects. Works on scalars and arrays.
+def flow_path_t(x, x1, x2, curve, iterations=40):
+  dx = x2 - x1
+  c = curve
+  u = np.clip((np.asarray(x, dtype=float) - x1) / dx, 0, 1)
+  lo = np.zeros_like(u)
+  hi = np.ones_like(u)
+  for i in range(iterations):
+    t = (lo + hi) / 2.0
+    xt = 3*c*(1-t)**2*t + 3*(1-c)*(1-t)*t**2 + t**3
+    lo = np.where(xt < u, t, lo)
+    hi = np.where(xt < u, hi, t)
+  return (lo + hi) / 2.0
+
+# Fraction of the vertical distance y1..y2 covered at Bezier parameter t.
+# Both inner control points of horiz_flow_path are level with their end points.
+def flow_path_h(t):
+  return t * t * (3 - 2*t)
 
-    for step1, step2 in zip(steps[:-1], steps[1:]):
-      # edge sizes
-      pos = self.miny
-      for node1 in nodes:
-        for node2 in nodes:
+# Answers "which node or flow is at this point/in this rectangle" queries for 
+# an AlluvialFlowLayout, in data coordinates.
+# Nodes are indexed as sorted port intervals per step. Flows are indexed per 
+# step pair: the pair's x-range is split into vertical slabs, and each slab 
+# keeps the flow bands sorted by their lower bound.
+# Flows are treated as bands as high as their port, rather than their slightly 
+# narrower rendered line width, so adjacent flows leave no gaps.
+# curve: the DiagramStyle curve used to draw the flows
+# slabs: number of slabs per step pair
+class AlluvialFlowHitIndex:
+  def __init__(self, alluvial_flow_layout, curve=0.4, slabs=16):
+    self.layout = alluvial_flow_layout
+    self.curve = curve
+    self.slabs = slabs
+    self.__index_nodes()
+    self.__index_flows()
+  
+  def __index_nodes(self):
+    layout = self.layout
+    # sorted step positions
+    self.steps = sorted(layout.steps, key=lambda step: layout.step_x[step])
+    self.step_xs = [layout.step_x[step] for step in self.steps]
+    # step -> (y1 array, y2 array, node list), for src and dst ports
+    self.src_ports = dict()
+    self.dst_ports = dict()
+    for ports, node_y1, node_y2 in [
+        (self.src_ports, layout.node1_y1, layout.node1_y2), 
+        (self.dst_ports, layout.node2_y1, layout.node2_y2)]:
+      for step in layout.steps:
+        entries = []
+        for node in layout.nodes:
           try:
-            flow = flows.loc[step1, node1, step2, node2]
-            size = self.scale_weights(flow['size'])
-            self.edge_size[step1][node1][node2] = size
+            entries.append((node_y1[step][node], node_y2[step][node], node))
           except KeyError:
-            # skip missing node/flow entries... this awkward code pattern repeats below.
             pass
-        
-      # source ports
-      pos = self.miny
-      for node1 in nodes:
-        self.node1_y1[step1][node1] = pos
-        try:
-          node = sequence.loc[step1, node1]
-          node_size = self.scale_weights(node['size'])
-          total_node_flow_size = 0
-          for node2 in nodes:
-            try:
-              flow = flows.loc[step1, node1, step2, node2]
-              size = self.scale_weights(flow['size'])
-              self.edge_node1_y[step1][node1][node2] = pos + (size/2.0)
-              total_node_flow_size += size
-              pos += size
-            except KeyError:
-              pass
-          if self.show_stationary_component:
-            pos += node_size - total_node_flow_size # "in" flow
-        except KeyError:
-          pass
-        self.node1_y2[step1][node1] = pos
-        if self.compact==False:
-          pos = self.node1_y1[step1][node1] + self.node_maxsize[node1]
-        pos += self.node_margin
-      self.maxy = max(self.maxy, pos)
-        
-      # destination ports
-      pos = self.miny
-      for node2 in nodes:
-        self.node2_y1[step2][node2] = pos
-        try:
-          node = sequence.loc[step2, node2]
-          node_size = self.scale_weights(node['size'])
-          total_node_flow_size = 0
-          for node1 in nodes:
-            try:
-              flow = flows.loc[step1, node1, step2, node2]
-              size = self.scale_weights(flow['size'])
-              self.edge_node2_y[step2][node1][node2] = pos + (size/2.0)
-              total_node_flow_size += size
-              pos += size
-            except KeyError:
-              pass
-          if self.show_stationary_component:
-            pos += node_size - total_node_flow_size # "out" flow
-        except KeyError:
-          pass
-        self.node2_y2[step2][node2] = pos
-        if self.compact==False:
-          pos = self.node2_y1[step2][node2] + self.node_maxsize[node2]
-        pos += self.node_margin
-      self.maxy = max(self.maxy, pos)
+        entries.sort(key=lambda entry: entry[0])
+        ports[step] = (
+          np.array([y1 for y1, y2, node in entries], dtype=float),
+          np.array([y2 for y1, y2, node in entries], dtype=float),
+          [node for y1, y2, node in entries])
+  
+  def __index_flows(self):
+    layout = self.layout
+    node_w = layout.node_width / 2.0
+    self.step_pairs = sorted(zip(layout.steps[:-1], layout.steps[1:]), 
+                 key=lambda pair: layout.step_x[pair[0]])
+    self.pair_x1 = np.array([layout.step_x[step1] + node_w for step1, step2 in self.step_pairs], dtype=float)
+    self.pair_x2 = np.array([layout.step_x[step2] - node_w for step1, step2 in self.step_pairs], dtype=float)
+    self.pair_flows = []
+    for (step1, step2), x1, x2 in zip(self.step_pairs, self.pair_x1, self.pair_x2):
+      keys = []
+      y1 = []
+      y2 = []
+      half = []
+      for node1 in layout.nodes:
+        for node2 in layout.nodes:
+          try:
+            flow_y1 = layout.edge_node1_y[step1][node1][node2]
+            flow_y2 = layout.edge_node2_y[step2][node1][node2]
+          except KeyError:
+            continue
+          keys.append((step1, node1, step2, node2))
+          y1.append(flow_y1)
+          y2.append(flow_y2)
+          half.append(layout.edge_size[step1][node1][node2] / 2.0)
+      y1 = np.array(y1, dtype=float)
+      y2 = np.array(y2, dtype=float)
+      half = np.array(half, dtype=float)
+      # vertical extent of each flow band within each slab
+      slab_x = np.linspace(x1, x2, self.slabs + 1)
+      slab_h = flow_path_h(flow_path_t(slab_x, x1, x2, self.curve))
+      slabs = []
+      for ha, hb in zip(slab_h[:-1], slab_h[1:]):
+        ya = y1 + (y2 - y1) * ha
+        yb = y1 + (y2 - y1) * hb
+        lo = np.minimum(ya, yb) - half
+        hi = np.maximum(ya, yb) + half
+        order = np.argsort(lo, kind='mergesort')
+        max_height = (hi - lo).max() if len(lo) else 0
+        slabs.append((lo[order], hi[order], order, max_height))
+      self.pair_flows.append((keys, y1, y2, half, slab_x, slabs))
+  
+  # Index of the step pair whose flow x-range includes x, or None.
+  def __pair_at(self, x):
+    idx = bisect_right(self.pair_x1, x) - 1
+    if idx < 0 or x > self.pair_x2[idx]:
+      return None
+    return idx
+  
+  # Candidate flow indices in a slab with bands that may intersect [y1, y2].
+  def __slab_candidates(self, slab, y1, y2):
+    lo, hi, order, max_height = slab
+    start = np.searchsorted(lo, y1 - max_height, side='left')
+    end = np.searchsorted(lo, y2, side='right')
+    sel = np.arange(start, end)
+    return order[sel[hi[sel] >= y1]]
+  
+  def __ports_at(self, ports, step, y1, y2):
+    port_y1, port_y2, nodes = ports[step]
+    start = max(bisect_right(port_y1, y1) - 1, 0)
+    end = bisect_right(port_y1, y2)
+    return [(step, nodes[idx]) for idx in range(start, end)
+        if port_y1[idx] <= y2 and port_y2[idx] >= y1]
+
+  # Returns a list of (step, node) tuples for all node ports in the rectangle.
+  def find_nodes_in_rect(self, x1, y1, x2, y2):
+    x1, x2 = sorted((x1, x2))
+    y1, y2 = sorted((y1, y2))
+    w = self.layout.node_width
+    found = []
+    start = bisect_left(self.step_xs, x1 - w)
+    end = bisect_right(self.step_xs, x2 + w)
+    for step, x in zip(self.steps[start:end], self.step_xs[start:end]):
+      # src ports span [x, x+w], dst ports [x-w, x]
+      if x <= x2 and x + w >= x1 and step in self.src_ports:
+        found.extend(self.__ports_at(self.src_ports, step, y1, y2))
+      if x - w <= x2 and x >= x1 and step in self.dst_ports:
+        found.extend(self.__ports_at(self.dst_ports, step, y1, y2))
+    # a node can have both a src and a dst port at the same step
+    return sorted(set(found), key=found.index)
+
+  # Returns a list of (step, node) tuples for all node ports at this point.
+  def find_nodes(self, x, y):
+    return self.find_nodes_in_rect(x, y, x, y)
+
+  # Returns a list of (step1, node1, step2, node2) tuples for all flows at this point.
+  def find_flows(self, x, y):
+    idx = self.__pair_at(x)
+    if idx is None:
+      return []
+    keys, y1, y2, half, slab_x, slabs = self.pair_flows[idx]
+    slab = min(max(np.searchsorted(slab_x, x, side='right') - 1, 0), self.slabs - 1)
+    candidates = self.__slab_candidates(slabs[slab], y, y)
+    h = flow_path_h(flow_path_t(x, self.pair_x1[idx], self.pair_x2[idx], self.curve))
+    yc = y1[candidates] + (y2[candidates] - y1[candidates]) * h
+    hits = candidates[np.abs(yc - y) <= half[candidates]]
+    return [keys[i] for i in sorted(hits)]
 
+  # Returns a list of (step1, node1, step2, node2) tuples for all flows that 
+  # intersect the rectangle.
+  def find_flows_in_rect(self, x1, y1, x2, y2):
+    x1, x2 = sorted((x1, x2))
+    y1, y2 = sorted((y1, y2))
+    found = []
+    start = max(bisect_right(self.pair_x1, x1) - 1, 0)
+    end = bisect_right(self.pair_x1, x2)
+    for idx in range(start, end):
+      pair_x1, pair_x2 = self.pair_x1[idx], self.pair_x2[idx]
+      if pair_x2 < x1:
+        continue
+      keys, fy1, fy2, half, slab_x, slabs = self.pair_flows[idx]
+      xa, xb = max(x1, pair_x1), min(x2, pair_x2)
+      first = min(max(np.searchsorted(slab_x, xa, side='right') - 1, 0), self.slabs - 1)
+      last = min(max(np.searchsorted(slab_x, xb, side='right') - 1, 0), self.slabs - 1)
+      candidates = np.unique(np.concatenate(
+        [self.__slab_candidates(slabs[slab], y1, y2) for slab in range(first, last + 1)]))
+      # flow centres are monotonic in x, so the clipped band is exact
+      ha, hb = flow_path_h(flow_path_t(np.array([xa, xb]), pair_x1, pair_x2, self.curve))
+      ya = fy1[candidates] + (fy2[candidates] - fy1[candidates]) * ha
+      yb = fy1[candidates] + (fy2[candidates] - fy1[candidates]) * hb
+      lo = np.minimum(ya, yb) - half[candidates]
+      hi = np.maximum(ya, yb) + half[candidates]
+      hits = candidates[(lo <= y2) & (hi >= y1)]
+      found.extend(keys[i] for i in hits)
+    return found
 
 # ==========
 # = Styles =
@@ -476,6 +889,57 @@ def flow_patch(x1, y1, x2, y2, size, color=None, curve=0.7, **kwargs):
                linewidth=size, edgecolor=color,
                facecolor='none', **kwargs)
 
+# Groups paths into one PathCollection per zorder.
+# zorders: list of zorders, one per path. None means the default patch zorder, 
+#   as for the patches that plot() creates.
+# props: collection properties; array values have one entry per path
+def zorder_collections(paths, zorders, **props):
+  zorders = np.array([patches.Patch.zorder if zorder is None else zorder 
+    for zorder in zorders], dtype=float)
+  collections = []
+  for zorder in np.unique(zorders):
+    idx = np.flatnonzero(zorders==zorder)
+    collections.append(PathCollection([paths[i] for i in idx], zorder=zorder, 
+      **dict((name, value[idx] if isinstance(value, np.ndarray) else value) 
+        for name, value in props.items())))
+  return collections
+
+# Adds and removes artists as the x-range of an axes changes, so that only 
+# artists within the current view limits are materialised and drawn.
+# extents: a list of (x1, x2) ranges, one per artist group
+# factory: a function that takes an extent index and returns a list of new artists
+class ViewportCuller:
+  def __init__(self, ax, extents, factory):
+    self.ax = ax
+    self.factory = factory
+    # sorted by x1, so that intersection tests only need to look at a narrow slice
+    order = sorted(range(len(extents)), key=lambda idx: extents[idx][0])
+    self.index = order
+    self.x1 = [extents[idx][0] for idx in order]
+    self.x2 = [extents[idx][1] for idx in order]
+    self.max_width = max([x2 - x1 for x1, x2 in extents] or [0])
+    self.artists = dict() # extent index -> list of artists
+    # the registry only keeps weak references to bound methods
+    self.cid = ax.callbacks.connect('xlim_changed', lambda ax: self.update())
+  
+  # extent indices that intersect [xmin, xmax]
+  def visible(self, xmin, xmax):
+    lo = bisect_left(self.x1, xmin - self.max_width)
+    hi = bisect_right(self.x1, xmax)
+    return set(self.index[pos] for pos in range(lo, hi) if self.x2[pos] >= xmin)
+  
+  def update(self):
+    xmin, xmax = sorted(self.ax.get_xlim())
+    visible = self.visible(xmin, xmax)
+    for idx in set(self.artists.keys()) - visible:
+      for artist in self.artists.pop(idx):
+        artist.remove()
+    for idx in visible - set(self.artists.keys()):
+      self.artists[idx] = [self.ax.add_artist(artist) for artist in self.factory(idx)]
+  
+  def disconnect(self):
+    self.ax.callbacks.disconnect(self.cid)
+
 # ========
 # = Plot =
 # ========
@@ -486,71 +950,211 @@ class AlluvialFlowDiagram:
   def __init__(self, alluvial_flow_layout):
     self.layout = alluvial_flow_layout
   
+  # Returns a list of flow patches between two steps.
+  # line_scale: data units to points
+  def edge_patches(self, step1, step2, style, line_scale):
+    artists = []
+    for node1 in self.layout.nodes:
+      for node2 in self.layout.nodes:
+        try:
+          size = self.layout.edge_size[step1][node1][node2]
+          line_width = (size * line_scale) * 0.8  # corresponding width in points
+          node_w = self.layout.node_width / 2.0 #* 1.5 # slight overlap
+          artists.append(flow_patch(
+            self.layout.step_x[step1] + node_w,
+            self.layout.edge_node1_y[step1][node1][node2],
+            self.layout.step_x[step2] - node_w,
+            self.layout.edge_node2_y[step2][node1][node2], 
+            size=line_width, 
+            color=style.get_edgecolor(step1, node1, step2, node2),
+            alpha=style.get_edgealpha(step1, node1, step2, node2),
+            zorder=style.get_edgezorder(step1, node1, step2, node2), 
+            curve=style.get_curve()
+          ))
+        except KeyError:
+          # TODO.. eww
+          pass
+    return artists
+  
+  # Returns a list of source and destination port patches between two steps.
+  def node_patches(self, step1, step2, style):
+    artists = []
+    for node in self.layout.nodes:
+      try:
+        # src port
+        x = self.layout.step_x[step1] + self.layout.node_width/2.0
+        y1 = self.layout.node1_y1[step1][node]
+        y2 = self.layout.node1_y2[step1][node]
+        artists.append(box_patch(
+            x, (y1+y2)/2.0, 
+            w=self.layout.node_width, h=(y2-y1),
+            label=node, 
+            color=style.get_nodecolor(node), 
+            alpha=style.get_nodealpha(node),
+            zorder=style.get_nodezorder(node)
+          ))
+
+        # dst port
+        x = self.layout.step_x[step2] - self.layout.node_width/2.0
+        y1 = self.layout.node2_y1[step2][node]
+        y2 = self.layout.node2_y2[step2][node]
+        artists.append(box_patch(
+            x, (y1+y2)/2.0, 
+            w=self.layout.node_width, h=(y2-y1),
+            label=node, 
+            color=style.get_nodecolor(node), 
+            alpha=style.get_nodealpha(node),
+            zorder=style.get_nodezorder(node)
+          ))  
+      except KeyError:
+        # TODO.. eww
+        pass
+    return artists
+  
+  # Returns flow and node geometry for plot_grid, independent of style: 
+  # a list of (step1, node1, step2, node2, x1, y1, x2, y2, size) flows, and 
+  # a list of (node, box path) ports.
+  def grid_geometry(self):
+    layout = self.layout
+    node_w = layout.node_width / 2.0
+    flows = []
+    boxes = []
+    for step1, step2 in zip(layout.steps[:-1], layout.steps[1:]):
+      for node1 in layout.nodes:
+        for node2 in layout.nodes:
+          try:
+            flows.append((step1, node1, step2, node2, 
+              layout.step_x[step1] + node_w, layout.edge_node1_y[step1][node1][node2], 
+              layout.step_x[step2] - node_w, layout.edge_node2_y[step2][node1][node2], 
+              layout.edge_size[step1][node1][node2]))
+          except KeyError:
+            pass
+      for node in layout.nodes:
+        try:
+          for x, y1, y2 in [
+              (layout.step_x[step1] + node_w, layout.node1_y1[step1][node], layout.node1_y2[step1][node]), 
+              (layout.step_x[step2] - node_w, layout.node2_y1[step2][node], layout.node2_y2[step2][node])]:
+            boxes.append((node, box_path(x, (y1+y2)/2.0, w=layout.node_width, h=(y2-y1))))
+        except KeyError:
+          pass
+    return flows, boxes
+  
+  def step_label(self, step, style):
+    return Text(self.layout.step_x[step], 0 - self.layout.node_margin, 
+           step, rotation='vertical', color=style.get_textcolor(),
+           horizontalalignment='center', verticalalignment='top',
+           clip_on=False)
+  
   # size: plot size as (x, y) tuple
   # style: a DiagramStyle instance
   # credits: copyright string
-  def plot(self, size=(16,9), style=SimpleStyle(), credits=None):
+  # viewport: only draw flows, nodes and step labels within the current x-range, 
+  #   and update them when the view limits change. For long timelines in interactive backends.
+  # xlim: initial (xmin, xmax) view range, defaults to the full diagram
+  def plot(self, size=(16,9), style=SimpleStyle(), credits=None, viewport=False, xlim=None):
     fig = plt.figure(figsize=size, facecolor=style.get_facecolor())
-    ax = plt.gca()
+    self.draw(plt.gca(), size[1] * 72.0, style=style, credits=credits, 
+      viewport=viewport, xlim=xlim)
+    return fig
+  
+  # Plots one panel per style in a grid within a single figure, e.g. to show 
+  # the same flows with different ingroup highlights. Flow paths and node 
+  # boxes are computed once and shared by all panels; each panel draws them as 
+  # a few path collections with its own colours and zorders. Panels have no 
+  # legend or credits.
+  # styles: a list of DiagramStyle instances
+  # ncols: number of grid columns, defaults to a near-square grid
+  # size: plot size as (x, y) tuple
+  # titles: optional list of panel titles
+  def plot_grid(self, styles, ncols=None, size=(16,9), titles=None):
+    ncols = ncols or int(np.ceil(np.sqrt(len(styles))))
+    nrows = int(np.ceil(len(styles) / float(ncols)))
+    fig = plt.figure(figsize=size, facecolor=styles[0].get_facecolor())
+    axes = fig.subplots(nrows, ncols, squeeze=False).flatten()
+    for ax in axes[len(styles):]:
+      ax.axis('off')
     
-    # edges
-    point_height = size[1] * 72.0
-    yrange = self.layout.maxy - self.layout.miny
+    point_height = size[1] * 72.0 / nrows
+    line_scale = point_height / (self.layout.maxy - self.layout.miny)
+    flows, boxes = self.grid_geometry()
+    line_widths = np.array([flow[8] for flow in flows], dtype=float) * line_scale * 0.8
+    box_paths = [path for node, path in boxes]
+    flow_paths = dict() # curve -> paths
     
-    for step1, step2 in zip(self.layout.steps[:-1], self.layout.steps[1:]):
-      for node1 in self.layout.nodes:
-        for node2 in self.layout.nodes:
-          try:
-            size = self.layout.edge_size[step1][node1][node2]
-            line_width = (size * (point_height / yrange)) * 0.8  # corresponding width in points
-            node_w = self.layout.node_width / 2.0 #* 1.5 # slight overlap
-            ax.add_patch(flow_patch(
-              self.layout.step_x[step1] + node_w,
-              self.layout.edge_node1_y[step1][node1][node2],
-              self.layout.step_x[step2] - node_w,
-              self.layout.edge_node2_y[step2][node1][node2], 
-              size=line_width, 
-              color=style.get_edgecolor(step1, node1, step2, node2),
-              alpha=style.get_edgealpha(step1, node1, step2, node2),
-              zorder=style.get_edgezorder(step1, node1, step2, node2), 
-              curve=style.get_curve()
-            ))
-          except KeyError:
-            # TODO.. eww
-            pass
+    for idx, (style, ax) in enumerate(zip(styles, axes)):
+      curve = style.get_curve()
+      if curve not in flow_paths:
+        flow_paths[curve] = [horiz_flow_path(x1, y1, x2, y2, curve) 
+          for step1, node1, step2, node2, x1, y1, x2, y2, size in flows]
+      
+      # edges
+      edge_colors = np.array([
+          to_rgba(style.get_edgecolor(*flow[:4]), style.get_edgealpha(*flow[:4])) 
+          for flow in flows]).reshape(-1, 4)
+      edge_zorders = [style.get_edgezorder(*flow[:4]) for flow in flows]
+      for collection in zorder_collections(flow_paths[curve], edge_zorders, 
+          edgecolors=edge_colors, linewidths=line_widths, facecolors='none'):
+        ax.add_collection(collection, autolim=False)
+      
+      # nodes
+      node_colors = np.array([
+          to_rgba(style.get_nodecolor(node), style.get_nodealpha(node)) 
+          for node, path in boxes]).reshape(-1, 4)
+      node_zorders = [style.get_nodezorder(node) for node, path in boxes]
+      for collection in zorder_collections(box_paths, node_zorders, 
+          facecolors=node_colors, linewidths=0, edgecolors='none'):
+        ax.add_collection(collection, autolim=False)
+      
+      # step labels
+      for step in self.layout.steps:
+        ax.add_artist(self.step_label(step, style))
+      
+      if titles:
+        ax.set_title(titles[idx], color=style.get_textcolor())
+      ax.axis('off')
+      ax.set_ylim(self.layout.miny, self.layout.maxy)
+      ax.set_xlim(self.layout.minx, self.layout.maxx)
     
-    # nodes
-    for step1, step2 in zip(self.layout.steps[:-1], self.layout.steps[1:]):
-      for node in self.layout.nodes:
-        try:
-          # src port
-          x = self.layout.step_x[step1] + self.layout.node_width/2.0
-          y1 = self.layout.node1_y1[step1][node]
-          y2 = self.layout.node1_y2[step1][node]
-          ax.add_patch(box_patch(
-              x, (y1+y2)/2.0, 
-              w=self.layout.node_width, h=(y2-y1),
-              label=node, 
-              color=style.get_nodecolor(node), 
-              alpha=style.get_nodealpha(node),
-              zorder=style.get_nodezorder(node)
-            ))
-
-          # dst port
-          x = self.layout.step_x[step2] - self.layout.node_width/2.0
-          y1 = self.layout.node2_y1[step2][node]
-          y2 = self.layout.node2_y2[step2][node]
-          ax.add_patch(box_patch(
-              x, (y1+y2)/2.0, 
-              w=self.layout.node_width, h=(y2-y1),
-              label=node, 
-              color=style.get_nodecolor(node), 
-              alpha=style.get_nodealpha(node),
-              zorder=style.get_nodezorder(node)
-            ))  
-        except KeyError:
-          # TODO.. eww
-          pass
+    return fig
+  
+  # Draws the diagram into an existing Axes. Does not use pyplot, so it can be 
+  # used with a plain Figure, e.g. when rendering in worker threads.
+  # ax: a matplotlib Axes
+  # point_height: axes height in points, for line widths
+  # Other parameters: see plot()
+  def draw(self, ax, point_height, style=SimpleStyle(), credits=None, viewport=False, xlim=None):
+    yrange = self.layout.maxy - self.layout.miny
+    line_scale = point_height / yrange
+    step_pairs = list(zip(self.layout.steps[:-1], self.layout.steps[1:]))
+    
+    if viewport:
+      # edges and nodes, by step pair
+      def step_pair_artists(idx):
+        step1, step2 = step_pairs[idx]
+        return self.edge_patches(step1, step2, style, line_scale) + \
+          self.node_patches(step1, step2, style)
+      ViewportCuller(ax, 
+        [(self.layout.step_x[step1], self.layout.step_x[step2]) for step1, step2 in step_pairs],
+        step_pair_artists)
+      
+      # step labels
+      ViewportCuller(ax, 
+        [(self.layout.step_x[step], self.layout.step_x[step]) for step in self.layout.steps],
+        lambda idx: [self.step_label(self.layout.steps[idx], style)])
+    else:
+      # edges
+      for step1, step2 in step_pairs:
+        for patch in self.edge_patches(step1, step2, style, line_scale):
+          ax.add_patch(patch)
+      
+      # nodes
+      for step1, step2 in step_pairs:
+        for patch in self.node_patches(step1, step2, style):
+          ax.add_patch(patch)
+      
+      # step labels
+      for step in self.layout.steps:
+        ax.add_artist(self.step_label(step, style))
 
     # credits
     if credits:
@@ -565,15 +1169,9 @@ class AlluvialFlowDiagram:
         # to the right of last step
         x = self.layout.step_x[last_step] + 0.2
         y = 0
-      plt.text(x, y, credits, 
+      ax.text(x, y, credits, 
            rotation='vertical', color=style.get_textcolor(),
            horizontalalignment='center', verticalalignment='bottom')
-    
-    # step labels
-    for step in self.layout.steps:
-      plt.text(self.layout.step_x[step], 0 - self.layout.node_margin, 
-           step, rotation='vertical', color=style.get_textcolor(),
-           horizontalalignment='center', verticalalignment='top')
 
     # node legend
     if style.get_showlegend():
@@ -582,14 +1180,13 @@ class AlluvialFlowDiagram:
                  w=self.layout.node_width, h=self.layout.node_width, 
                  label=node, color=style.get_nodecolor(node), alpha=1)
             for node in rev_nodes]
-      leg = plt.legend(artists, rev_nodes, frameon=False)
+      leg = ax.legend(artists, rev_nodes, frameon=False)
       for node, txt in zip(rev_nodes, leg.get_texts()):
         txt.set_color(style.get_nodecolor(node))  
   #       txt.set_color(style.get_textcolor())
 
     # ax.autoscale_view()
-    plt.axis('off')
-    plt.xlim(self.layout.minx, self.layout.maxx)
-    plt.ylim(self.layout.miny, self.layout.maxy)
-    
-    return fig
\ No newline at end of file
+    ax.axis('off')
+    ax.set_ylim(self.layout.miny, self.layout.maxy)
+    # in viewport mode this triggers the first cull
+    ax.set_xlim(xlim or (self.layout.minx, self.layout.maxx))
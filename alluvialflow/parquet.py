@@ -0,0 +1,157 @@
+"""
+  alluvialflow.parquet
+  ~~~~~~~~~~~~~~~~~~~~
+
+  Flow models stored as Parquet datasets, partitioned by step.
+
+  :copyright: 2015 by Martin Dittus, martin@dekstop.de
+  :license: AGPL3, see LICENSE.txt for more details
+"""
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from alluvialflow.alluvialflow import FlowDataSource
+
+SEQUENCE_COLUMNS = ['step', 'node', 'size']
+FLOW_COLUMNS = ['step1', 'node1', 'step2', 'node2', 'size']
+
+# ===========
+# = Helpers =
+# ===========
+
+# Schema file written next to each dataset. Hive partition directories only 
+# hold the partition values as strings; this records their column types.
+SCHEMA_FILE = '_common_metadata'
+
+# Returns (filesystem, path) for a local path or a filesystem URI. Local files 
+# are memory-mapped if memory_map is set.
+def resolve_path(path, memory_map=True):
+  if '://' in str(path):
+    return pafs.FileSystem.from_uri(path)
+  return pafs.LocalFileSystem(use_mmap=memory_map), str(path)
+
+def write_dataset(table, path, partition_col):
+  filesystem, path = resolve_path(path)
+  pq.write_to_dataset(table, path, partition_cols=[partition_col], filesystem=filesystem)
+  pq.write_metadata(table.schema, path.rstrip('/') + '/' + SCHEMA_FILE, filesystem=filesystem)
+
+# Writes the sequence and flows of a FlowDataSource as Parquet datasets, with 
+# hive-style partitions by step (sequence) and step1 (flows).
+def write_parquet(flow_data_source, sequence_path, flows_path):
+  nodes, sequence, flows = flow_data_source.get_all()
+  write_dataset(
+    pa.Table.from_pandas(sequence.reset_index()[SEQUENCE_COLUMNS], preserve_index=False), 
+    sequence_path, 'step')
+  write_dataset(
+    pa.Table.from_pandas(flows.reset_index()[FLOW_COLUMNS], preserve_index=False), 
+    flows_path, 'step1')
+
+# Hive partitioning on a column, with the column type taken from the dataset's 
+# schema file. Without a schema file, pyarrow infers partition types, which 
+# turns numeric-looking labels into integers.
+def hive_partitioning(filesystem, path, column):
+  schema_path = path.rstrip('/') + '/' + SCHEMA_FILE
+  if filesystem.get_file_info(schema_path).type != pafs.FileType.File:
+    return 'hive'
+  schema = pq.read_schema(schema_path, filesystem=filesystem)
+  return ds.partitioning(pa.schema([schema.field(column)]), flavor='hive')
+
+# Combines filter expressions with AND. Returns None if there are none.
+def all_of(*exprs):
+  exprs = [expr for expr in exprs if expr is not None]
+  if len(exprs)==0:
+    return None
+  combined = exprs[0]
+  for expr in exprs[1:]:
+    combined = combined & expr
+  return combined
+
+# ===============
+# = Data source =
+# ===============
+
+# A FlowDataSource that reads Parquet datasets, as written by write_parquet.
+# Only reads the step/node/size columns. Step range and node filters are pushed 
+# down to the dataset scan, which skips partitions outside the step range and 
+# row groups whose statistics exclude the filter. Local files are memory-mapped;
+# other paths can be filesystem URIs.
+#
+# sequence_path, flows_path: dataset directories or files, local paths or URIs
+# nodes: ordered list of node names. Defaults to the sorted node names in the 
+#   step range (or to node_subset, if given).
+# first_step, last_step: inclusive step range, or None for unbounded
+# node_subset: a list of nodes to include, or None for all nodes
+# memory_map: memory-map local files
+# partitioning: a pyarrow partitioning; 'hive' uses the column types recorded 
+#   by write_parquet
+class ParquetFlowDataSource(FlowDataSource):
+  def __init__(self, sequence_path, flows_path, nodes=None, 
+         first_step=None, last_step=None, node_subset=None, 
+         memory_map=True, partitioning='hive'):
+    self.sequence_dataset = self.__dataset(sequence_path, 'step', memory_map, partitioning)
+    self.flows_dataset = self.__dataset(flows_path, 'step1', memory_map, partitioning)
+    self.nodes = nodes
+    self.first_step = first_step
+    self.last_step = last_step
+    self.node_subset = node_subset
+  
+  def __dataset(self, path, partition_col, memory_map, partitioning):
+    filesystem, path = resolve_path(path, memory_map)
+    if partitioning=='hive':
+      partitioning = hive_partitioning(filesystem, path, partition_col)
+    return ds.dataset(path, format='parquet', 
+      partitioning=partitioning, filesystem=filesystem)
+  
+  def __range_filter(self, field, first_step, last_step):
+    return all_of(
+      None if first_step is None else ds.field(field) >= first_step, 
+      None if last_step is None else ds.field(field) <= last_step)
+  
+  def __node_filter(self, field):
+    if self.node_subset is None:
+      return None
+    return ds.field(field).isin(self.node_subset)
+  
+  def __read_sequence(self):
+    return self.sequence_dataset.to_table(columns=SEQUENCE_COLUMNS, 
+      filter=all_of(
+        self.__range_filter('step', self.first_step, self.last_step), 
+        self.__node_filter('node'))).to_pandas()
+  
+  def __read_flows(self):
+    return self.flows_dataset.to_table(columns=FLOW_COLUMNS, 
+      filter=all_of(
+        # step1 < step2, so the upper bound also prunes step1 partitions
+        self.__range_filter('step1', self.first_step, self.last_step), 
+        self.__range_filter('step2', None, self.last_step), 
+        self.__node_filter('node1'), 
+        self.__node_filter('node2'))).to_pandas()
+  
+  def __nodes(self, sequence):
+    if self.nodes is not None:
+      return self.nodes
+    if self.node_subset is not None:
+      return list(self.node_subset)
+    return sorted(sequence.node.unique())
+  
+  def get_nodes(self):
+    if self.nodes is not None:
+      return self.nodes
+    return self.__nodes(self.__read_sequence())
+  
+  # returns a DataFrame[step, node; size]
+  def get_sequence(self): 
+    return self.__read_sequence().set_index(['step', 'node'])
+  
+  # returns a DataFrame[step1, node1, step2, node2; size]
+  def get_flows(self): 
+    return self.__read_flows().set_index(['step1', 'node1', 'step2', 'node2'])
+  
+  def get_all(self):
+    sequence = self.__read_sequence()
+    return self.__nodes(sequence), \
+      sequence.set_index(['step', 'node']), \
+      self.__read_flows().set_index(['step1', 'node1', 'step2', 'node2'])
@@ -0,0 +1,148 @@
+"""
+  alluvialflow.rollup
+  ~~~~~~~~~~~~~~~~~~~
+
+  Flow models at multiple step and node resolutions, derived from a single 
+  fine-grained model without going back to its source.
+
+  :copyright: 2015 by Martin Dittus, martin@dekstop.de
+  :license: AGPL3, see LICENSE.txt for more details
+"""
+
+import pandas as pd
+
+from alluvialflow.alluvialflow import StaticFlowDataSource
+from alluvialflow.sketch import SketchFlowDataSource
+
+# ===========
+# = Helpers =
+# ===========
+
+# Applies a dict or function to every value of a Series, calling it once per 
+# distinct value. Values that are missing from a dict are kept as they are.
+def map_values(series, mapping):
+  if isinstance(mapping, dict):
+    mapping = (lambda d: lambda value: d.get(value, value))(mapping)
+  codes, uniques = pd.factorize(series)
+  mapped = pd.Series([mapping(value) for value in uniques], dtype=object)
+  return mapped.values[codes]
+
+# Sums up sizes for the given key columns.
+def sum_sizes(d, keys):
+  return d.groupby(keys, sort=True, as_index=False)['size'].sum()
+
+# ==========
+# = Rollup =
+# ==========
+
+# A pyramid of pre-aggregated flow models.
+# Stores the sequence and flows at their finest resolution, and derives coarser 
+# step bins and node groupings on request. Every roll-up is cached, and coarser 
+# resolutions are computed from finer cached ones rather than from the source.
+#
+# For a SketchFlowDataSource, roll-ups union the entity sketches, so coarse 
+# sizes and flows are estimates of the distinct entities per coarse step and 
+# node group, as a query at that resolution would produce.
+# For other sources, node groupings sum up sizes, so they need to be additive: 
+# counts of events, sums, ... Distinct counts (e.g. of contributors) can't be 
+# rolled up this way, so summed groupings need to be enabled with additive=True.
+# Step roll-ups need sketches: flows between coarse steps can't be derived from 
+# flows between fine steps.
+class FlowRollup:
+  # flow_data_source: a FlowDataSource instance at the finest resolution
+  def __init__(self, flow_data_source):
+    self.step_resolutions = dict() # name -> (parent name, step map)
+    self.node_groupings = dict() # name -> (node map, ordered list of groups)
+    # (step resolution, node grouping) -> (nodes, sequence, flows, data source)
+    self.cache = dict()
+    self.sketches = isinstance(flow_data_source, SketchFlowDataSource)
+    if self.sketches:
+      # (step resolution, node grouping) -> SketchFlowDataSource
+      self.sketch_cache = {(None, None): flow_data_source}
+    else:
+      nodes, sequence, flows = flow_data_source.get_all()
+      self.__store(None, None, nodes, sequence.reset_index(), flows.reset_index())
+  
+  # name: a resolution name, e.g. 'month'
+  # step_map: a dict or function that maps steps at the parent resolution to 
+  #   coarser step labels. These need to sort in time order.
+  # parent: the name of a finer resolution, or None for the source steps
+  def add_step_resolution(self, name, step_map, parent=None):
+    if not self.sketches:
+      raise Exception('Step roll-ups need a SketchFlowDataSource')
+    if name is None or name in self.step_resolutions:
+      raise Exception('Step resolution already defined: %s' % name)
+    if parent is not None and parent not in self.step_resolutions:
+      raise Exception('Unknown step resolution: %s' % parent)
+    self.step_resolutions[name] = (parent, step_map)
+  
+  # name: a grouping name, e.g. 'region'
+  # node_map: a dict or function that maps source nodes to group names
+  # nodes: ordered list of group names. Defaults to their order of first 
+  #   appearance in the source node list.
+  # additive: sizes are additive, and can be summed up for sources without 
+  #   sketches
+  def add_node_grouping(self, name, node_map, nodes=None, additive=False):
+    if not (self.sketches or additive):
+      raise Exception('Summed node groupings need additive sizes. '
+        'Use a SketchFlowDataSource, or pass additive=True.')
+    if name is None or name in self.node_groupings:
+      raise Exception('Node grouping already defined: %s' % name)
+    self.node_groupings[name] = (node_map, nodes)
+  
+  # Returns a FlowDataSource for a step resolution and node grouping.
+  # Either can be None for the source resolution.
+  def get(self, step_resolution=None, node_grouping=None):
+    return self.__rollup(step_resolution, node_grouping)[3]
+  
+  def __store(self, step_resolution, node_grouping, nodes, sequence, flows):
+    data_source = StaticFlowDataSource(nodes, 
+      sequence.set_index(['step', 'node']), 
+      flows.set_index(['step1', 'node1', 'step2', 'node2']))
+    self.cache[(step_resolution, node_grouping)] = (nodes, sequence, flows, data_source)
+    return self.cache[(step_resolution, node_grouping)]
+  
+  def __rollup(self, step_resolution, node_grouping):
+    key = (step_resolution, node_grouping)
+    if key in self.cache:
+      return self.cache[key]
+    if self.sketches:
+      # estimate sizes and flows once, with their errors
+      sketches = self.__rollup_sketches(step_resolution, node_grouping)
+      return self.__store(step_resolution, node_grouping, sketches.get_nodes(), 
+        sketches.get_sequence().reset_index(), sketches.get_flows().reset_index())
+    # node groups, from the source steps
+    node_map, group_nodes = self.node_groupings[node_grouping]
+    nodes, sequence, flows = self.__rollup(None, None)[:3]
+    if group_nodes is None:
+      groups = map_values(pd.Series(nodes, dtype=object), node_map)
+      group_nodes = list(pd.unique(groups))
+    nodes = group_nodes
+    sequence = sum_sizes(sequence.assign(
+      node=map_values(sequence.node, node_map)), ['step', 'node'])
+    flows = sum_sizes(flows.assign(
+      node1=map_values(flows.node1, node_map), 
+      node2=map_values(flows.node2, node_map)), 
+      ['step1', 'node1', 'step2', 'node2'])
+    return self.__store(step_resolution, node_grouping, nodes, sequence, flows)
+  
+  # Roll-ups of a SketchFlowDataSource, by merging sketches. Returns the 
+  # merged sketches, which are cached separately from their estimates.
+  def __rollup_sketches(self, step_resolution, node_grouping):
+    key = (step_resolution, node_grouping)
+    if key in self.sketch_cache:
+      return self.sketch_cache[key]
+    if step_resolution is not None:
+      # coarser steps, from the parent resolution with the same grouping
+      parent, step_map = self.step_resolutions[step_resolution]
+      sketches = self.__rollup_sketches(parent, node_grouping).rollup(step_map=step_map)
+    else:
+      # node groups, from the source steps
+      node_map, group_nodes = self.node_groupings[node_grouping]
+      sketches = self.__rollup_sketches(None, None)
+      if group_nodes is None:
+        groups = map_values(pd.Series(sketches.get_nodes(), dtype=object), node_map)
+        group_nodes = list(pd.unique(groups))
+      sketches = sketches.rollup(node_map=node_map, nodes=group_nodes)
+    self.sketch_cache[key] = sketches
+    return sketches
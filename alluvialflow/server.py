@@ -0,0 +1,234 @@
+"""
+  alluvialflow.server
+  ~~~~~~~~~~~~~~~~~~~
+
+  A WSGI app that renders diagrams on request, with caches for flow data, 
+  layouts and images.
+  
+  Request format: /<source id>?first=<step>&last=<step>&style=<name>&format=png
+  All query parameters are optional; first and last default to the full step 
+  range, formats are png, pdf and svg.
+
+  :copyright: 2015 by Martin Dittus, martin@dekstop.de
+  :license: AGPL3, see LICENSE.txt for more details
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+import threading
+import traceback
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIServer
+from socketserver import ThreadingMixIn
+
+import pandas as pd
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from alluvialflow.alluvialflow import AlluvialFlowDiagram, SimpleStyle
+from alluvialflow.window import WindowedFlowStore
+
+CONTENT_TYPES = {
+  'png': 'image/png',
+  'pdf': 'application/pdf',
+  'svg': 'image/svg+xml',
+}
+
+# =========
+# = Cache =
+# =========
+
+# A thread-safe dict with a maximum size that evicts the least recently used 
+# entries.
+class LRUCache:
+  def __init__(self, maxsize=128):
+    self.maxsize = maxsize
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+  
+  # Returns None for missing keys.
+  def get(self, key):
+    with self.lock:
+      if key not in self.entries:
+        return None
+      self.entries.move_to_end(key)
+      return self.entries[key]
+  
+  def put(self, key, value):
+    with self.lock:
+      self.entries[key] = value
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+  
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+  
+  def __len__(self):
+    return len(self.entries)
+
+# ===========
+# = Service =
+# ===========
+
+# Raised for invalid requests, with an HTTP status.
+class RequestError(Exception):
+  def __init__(self, status, message):
+    Exception.__init__(self, message)
+    self.status = status
+
+# Renders diagrams for a fixed set of data sources and styles. Call render() 
+# directly, or use the instance as a WSGI app.
+# Flow data is loaded once per source and kept as a WindowedFlowStore, layouts 
+# are cached per step range, and images per step range, style and format. 
+# Concurrent requests for the same entry wait for a single computation.
+class RenderService:
+  # sources: dict of source id -> FlowDataSource
+  # styles: dict of style name -> DiagramStyle
+  # size: plot size as (x, y) tuple, in inches
+  # dpi: resolution of png images
+  # credits: copyright string
+  # workers: number of render threads
+  # *_cache_size: maximum number of cached entries
+  # layout_args: AlluvialFlowLayout parameters
+  def __init__(self, sources, styles=None, size=(16,9), dpi=72, credits=None, 
+      workers=4, flow_cache_size=16, layout_cache_size=64, image_cache_size=256, 
+      **layout_args):
+    self.sources = sources
+    self.styles = styles or {'simple': SimpleStyle()}
+    self.default_style = sorted(self.styles.keys())[0]
+    self.size = size
+    self.dpi = dpi
+    self.credits = credits
+    self.layout_args = layout_args
+    
+    self.flows = LRUCache(flow_cache_size)
+    self.layouts = LRUCache(layout_cache_size)
+    self.images = LRUCache(image_cache_size)
+    
+    # key -> Future, for computations in progress
+    self.pending = dict()
+    self.lock = threading.Lock()
+    self.executor = ThreadPoolExecutor(max_workers=workers)
+  
+  # Returns cache[key], or computes and caches it. Concurrent callers for 
+  # the same key wait for the first one.
+  def __cached(self, cache, key, compute):
+    value = cache.get(key)
+    if value is not None:
+      return value
+    with self.lock:
+      value = cache.get(key)
+      if value is not None:
+        return value
+      future = self.pending.get(key)
+      owner = future is None
+      if owner:
+        future = self.pending[key] = Future()
+    if not owner:
+      return future.result()
+    try:
+      value = compute()
+      cache.put(key, value)
+      future.set_result(value)
+      return value
+    except Exception as e:
+      future.set_exception(e)
+      raise
+    finally:
+      with self.lock:
+        del self.pending[key]
+  
+  def get_flow_store(self, source_id):
+    if source_id not in self.sources:
+      raise RequestError('404 Not Found', 'Unknown data source: %s' % source_id)
+    return self.__cached(self.flows, ('flows', source_id), 
+      lambda: WindowedFlowStore(self.sources[source_id]))
+  
+  # Converts a step from a request string to the type of the store's steps.
+  def parse_step(self, store, step):
+    if step is None:
+      return None
+    try:
+      return pd.Index([step]).astype(store.steps.dtype)[0]
+    except (TypeError, ValueError):
+      raise RequestError('400 Bad Request', 'Invalid step: %s' % step)
+  
+  # Returns the layout for an inclusive step range, and its (first, last) 
+  # step positions.
+  def get_layout(self, source_id, first_step=None, last_step=None):
+    store = self.get_flow_store(source_id)
+    first, last = store.get_step_range(
+      self.parse_step(store, first_step), self.parse_step(store, last_step))
+    if last < first:
+      raise RequestError('404 Not Found', 'Empty step range: %s to %s' % (first_step, last_step))
+    if last==first:
+      raise RequestError('400 Bad Request', 'Step range needs at least two steps: %s to %s' % (first_step, last_step))
+    steps = store.steps
+    layout = self.__cached(self.layouts, ('layout', source_id, first, last), 
+      lambda: store.get_layout(steps[first], steps[last], **self.layout_args))
+    return layout, (first, last)
+  
+  def draw(self, layout, style, format):
+    fig = Figure(figsize=self.size, facecolor=style.get_facecolor())
+    FigureCanvasAgg(fig)
+    AlluvialFlowDiagram(layout).draw(fig.add_subplot(111), self.size[1] * 72.0, 
+      style=style, credits=self.credits)
+    buf = BytesIO()
+    fig.savefig(buf, format=format, dpi=self.dpi, facecolor=fig.get_facecolor())
+    return buf.getvalue()
+  
+  # Returns the encoded image for a step range, style name and format.
+  # first_step, last_step: step values, or strings that can be converted to them
+  def render(self, source_id, first_step=None, last_step=None, style=None, format='png'):
+    style = style or self.default_style
+    if style not in self.styles:
+      raise RequestError('404 Not Found', 'Unknown style: %s' % style)
+    if format not in CONTENT_TYPES:
+      raise RequestError('400 Bad Request', 'Unknown format: %s' % format)
+    
+    layout, step_range = self.get_layout(source_id, first_step, last_step)
+    return self.__cached(self.images, ('image', source_id) + step_range + (style, format), 
+      lambda: self.executor.submit(self.draw, layout, self.styles[style], format).result())
+  
+  def error(self, start_response, status, message):
+    start_response(status, [('Content-Type', 'text/plain; charset=utf-8')])
+    return [message.encode('utf-8')]
+  
+  # WSGI entry point
+  def __call__(self, environ, start_response):
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    param = lambda name, default=None: query.get(name, [default])[0]
+    source_id = environ.get('PATH_INFO', '').strip('/')
+    format = param('format', 'png')
+    try:
+      image = self.render(source_id, param('first'), param('last'), 
+        param('style'), format)
+    except RequestError as e:
+      return self.error(start_response, e.status, str(e))
+    except Exception as e:
+      environ['wsgi.errors'].write(traceback.format_exc())
+      return self.error(start_response, '500 Internal Server Error', 
+        'Rendering failed: %s' % e.__class__.__name__)
+    start_response('200 OK', [
+      ('Content-Type', CONTENT_TYPES[format]),
+      ('Content-Length', str(len(image))),
+    ])
+    return [image]
+  
+  def shutdown(self):
+    self.executor.shutdown()
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+  daemon_threads = True
+
+# Serves a RenderService over HTTP, until interrupted.
+def serve(service, host='127.0.0.1', port=8000):
+  server = make_server(host, port, service, server_class=ThreadingWSGIServer)
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    service.shutdown()
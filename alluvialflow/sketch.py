@@ -0,0 +1,258 @@
+"""
+  alluvialflow.sketch
+  ~~~~~~~~~~~~~~~~~~~
+
+  Approximate distinct-entity flow models, based on mergeable sketches.
+
+  Each (step, node) keeps a HyperLogLog sketch of its entities (e.g. contributor 
+  IDs) for size estimates, and a bottom-k MinHash sketch for intersection 
+  estimates. Flows between two steps are estimated from the sketches alone, 
+  without a per-entity join. Sketches can be merged across data partitions, 
+  and unioned into coarser steps or node groups.
+
+  :copyright: 2015 by Martin Dittus, martin@dekstop.de
+  :license: AGPL3, see LICENSE.txt for more details
+"""
+
+import numpy as np
+import pandas as pd
+from pandas.util import hash_array
+
+from alluvialflow.alluvialflow import FlowDataSource
+
+# ===========
+# = Helpers =
+# ===========
+
+# Independent 64-bit hashes for the two sketch types.
+HLL_HASH_KEY = 'alluvialflow-hll'
+MINHASH_HASH_KEY = 'alluvialflow-min'
+
+# Stable 64-bit hashes of entity IDs, as uint64 array.
+# hash_array only uses hash_key for object values, so numeric values are 
+# salted with a key-derived constant before they are mixed.
+def hash_values(values, hash_key):
+  values = np.asarray(values)
+  if values.dtype.kind not in 'iufb':
+    return hash_array(values.astype(object), hash_key=hash_key)
+  if values.dtype.kind=='f':
+    bits = values.astype(np.float64).view(np.uint64)
+  else:
+    bits = values.astype(np.int64).view(np.uint64)
+  salt = hash_array(np.array([hash_key], dtype=object))[0]
+  return hash_array(bits ^ salt)
+
+# Number of bits needed to represent each value of a uint64 array.
+def bit_length(values):
+  values = values.copy()
+  length = np.zeros(len(values), dtype=np.uint8)
+  for shift in (32, 16, 8, 4, 2, 1):
+    big = values >= (np.uint64(1) << np.uint64(shift))
+    values[big] >>= np.uint64(shift)
+    length[big] += shift
+  return length + (values > 0)
+
+# ============
+# = Sketches =
+# ============
+
+# Cardinality estimates with a relative standard error of about 1.04/sqrt(2^precision).
+class HyperLogLog:
+  def __init__(self, precision=14, registers=None):
+    self.precision = precision
+    self.m = 1 << precision
+    if registers is None:
+      registers = np.zeros(self.m, dtype=np.uint8)
+    self.registers = registers
+  
+  # hashes: uint64 array
+  def add_hashes(self, hashes):
+    remainder_bits = 64 - self.precision
+    idx = (hashes >> np.uint64(remainder_bits)).astype(np.intp)
+    remainder = hashes & np.uint64((1 << remainder_bits) - 1)
+    rank = (remainder_bits + 1 - bit_length(remainder)).astype(np.uint8)
+    np.maximum.at(self.registers, idx, rank)
+    return self
+  
+  def add(self, values):
+    return self.add_hashes(hash_values(values, HLL_HASH_KEY))
+  
+  def merge(self, other):
+    if other.precision != self.precision:
+      raise Exception('Cannot merge sketches of different precision')
+    return HyperLogLog(self.precision, np.maximum(self.registers, other.registers))
+  
+  def relative_error(self):
+    return 1.04 / np.sqrt(self.m)
+  
+  def count(self):
+    m = float(self.m)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(int)))
+    if estimate <= 2.5 * m:
+      # small range correction
+      zeros = np.count_nonzero(self.registers==0)
+      if zeros > 0:
+        estimate = m * np.log(m / zeros)
+    return float(estimate)
+
+# Bottom-k MinHash: keeps the k smallest entity hashes. 
+# Jaccard estimates have a standard error of about sqrt(J(1-J)/k).
+class MinHash:
+  def __init__(self, k=4096, hashes=None):
+    self.k = k
+    if hashes is None:
+      hashes = np.zeros(0, dtype=np.uint64)
+    self.hashes = hashes # sorted, unique
+  
+  # hashes: uint64 array
+  def add_hashes(self, hashes):
+    self.hashes = np.union1d(self.hashes, hashes)[:self.k]
+    return self
+  
+  def add(self, values):
+    return self.add_hashes(hash_values(values, MINHASH_HASH_KEY))
+  
+  def merge(self, other):
+    k = min(self.k, other.k)
+    return MinHash(k, np.union1d(self.hashes, other.hashes)[:k])
+  
+  # Returns (Jaccard similarity estimate, its standard error)
+  def jaccard(self, other):
+    k = min(self.k, other.k)
+    union = np.union1d(self.hashes, other.hashes)[:k]
+    if len(union)==0:
+      return 0.0, 0.0
+    both = np.isin(union, self.hashes, assume_unique=True) & \
+      np.isin(union, other.hashes, assume_unique=True)
+    jaccard = np.count_nonzero(both) / float(len(union))
+    if len(union) < k:
+      # the sketches hold every entity: exact
+      return jaccard, 0.0
+    return jaccard, float(np.sqrt(jaccard * (1 - jaccard) / len(union)))
+
+# A set of entities, for size and intersection estimates.
+class EntitySketch:
+  def __init__(self, precision=14, k=4096, hll=None, minhash=None):
+    self.hll = hll or HyperLogLog(precision)
+    self.minhash = minhash or MinHash(k)
+  
+  def add(self, values):
+    self.hll.add(values)
+    self.minhash.add(values)
+    return self
+  
+  def merge(self, other):
+    return EntitySketch(hll=self.hll.merge(other.hll), 
+      minhash=self.minhash.merge(other.minhash))
+  
+  # Returns (size estimate, its standard error)
+  def count(self):
+    if len(self.minhash.hashes) < self.minhash.k:
+      # the MinHash sketch holds every entity: exact
+      return float(len(self.minhash.hashes)), 0.0
+    count = self.hll.count()
+    return float(count), float(count * self.hll.relative_error())
+  
+  # Returns (intersection size estimate, its standard error), based on the 
+  # Jaccard similarity and the size of the union.
+  def intersection(self, other):
+    jaccard, jaccard_error = self.minhash.jaccard(other.minhash)
+    union, union_error = self.merge(other).count()
+    estimate = jaccard * union
+    error = np.sqrt((jaccard_error * union)**2 + (jaccard * union_error)**2)
+    return float(estimate), float(error)
+
+# =================
+# = Sketch models =
+# =================
+
+# Builds a (step, node) -> EntitySketch dict from a DataFrame of entity activity.
+# timeline: DataFrame with step, node, and entity ID columns
+# uid: name of the entity ID column
+def sketch_timeline(timeline, uid='uid', precision=14, k=4096):
+  hll_hashes = hash_values(timeline[uid].values, HLL_HASH_KEY)
+  minhash_hashes = hash_values(timeline[uid].values, MINHASH_HASH_KEY)
+  sketches = dict()
+  for key, rows in timeline.groupby(['step', 'node'], sort=False).indices.items():
+    sketch = EntitySketch(precision, k)
+    sketch.hll.add_hashes(hll_hashes[rows])
+    sketch.minhash.add_hashes(minhash_hashes[rows])
+    sketches[key] = sketch
+  return sketches
+
+# Merges (step, node) -> EntitySketch dicts, e.g. of different data partitions.
+def merge_sketches(*sketch_dicts):
+  merged = dict()
+  for sketches in sketch_dicts:
+    for key, sketch in sketches.items():
+      merged[key] = merged[key].merge(sketch) if key in merged else sketch
+  return merged
+
+# Unions sketches into coarser steps and/or node groups.
+# step_map, node_map: a dict or function, or None to keep steps/nodes as they are
+def rollup_sketches(sketches, step_map=None, node_map=None):
+  def mapper(mapping):
+    if mapping is None:
+      return lambda value: value
+    if isinstance(mapping, dict):
+      return lambda value: mapping.get(value, value)
+    return mapping
+  map_step, map_node = mapper(step_map), mapper(node_map)
+  return merge_sketches(*[
+    {(map_step(step), map_node(node)): sketch} 
+    for (step, node), sketch in sketches.items()])
+
+# A FlowDataSource with sizes and flows estimated from sketches.
+# Sequence and flow frames have an additional "error" column with the standard 
+# error of each estimate.
+# nodes: ordered list of node names
+# sketches: (step, node) -> EntitySketch
+class SketchFlowDataSource(FlowDataSource):
+  def __init__(self, nodes, sketches):
+    self.nodes = nodes
+    self.sketches = sketches
+  
+  # timeline: DataFrame with step, node, and entity ID columns
+  @classmethod
+  def from_timeline(cls, nodes, timeline, uid='uid', precision=14, k=4096):
+    return cls(nodes, sketch_timeline(timeline, uid, precision, k))
+  
+  def merge(self, other):
+    return SketchFlowDataSource(self.nodes, merge_sketches(self.sketches, other.sketches))
+  
+  # nodes: ordered list of node names after mapping
+  def rollup(self, step_map=None, node_map=None, nodes=None):
+    return SketchFlowDataSource(nodes or self.nodes, 
+      rollup_sketches(self.sketches, step_map, node_map))
+  
+  def get_nodes(self):
+    return self.nodes
+  
+  def get_steps(self):
+    return sorted(set(step for step, node in self.sketches.keys()))
+  
+  # returns a DataFrame[step, node; size, error]
+  def get_sequence(self): 
+    rows = [(step, node) + self.sketches[(step, node)].count()
+        for step, node in sorted(self.sketches.keys())]
+    d = pd.DataFrame(rows, columns=['step', 'node', 'size', 'error'])
+    return d.set_index(['step', 'node'])
+  
+  # returns a DataFrame[step1, node1, step2, node2; size, error]
+  # Only includes flows with a non-zero estimate.
+  def get_flows(self): 
+    steps = self.get_steps()
+    step_nodes = dict((step, []) for step in steps)
+    for step, node in self.sketches.keys():
+      step_nodes[step].append(node)
+    rows = []
+    for step1, step2 in zip(steps[:-1], steps[1:]):
+      for node1 in sorted(step_nodes[step1]):
+        sketch1 = self.sketches[(step1, node1)]
+        for node2 in sorted(step_nodes[step2]):
+          size, error = sketch1.intersection(self.sketches[(step2, node2)])
+          if size > 0:
+            rows.append((step1, node1, step2, node2, size, error))
+    d = pd.DataFrame(rows, columns=['step1', 'node1', 'step2', 'node2', 'size', 'error'])
+    return d.set_index(['step1', 'node1', 'step2', 'node2'])
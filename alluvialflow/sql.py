@@ -2,18 +2,29 @@
   alluvialflow.sql
   ~~~~~~~~~~~~~~~~
 
-  SQL query fragments for flow models.
+  SQL query fragments and data sources for flow models.
 
   :copyright: 2015 by Martin Dittus, martin@dekstop.de
   :license: AGPL3, see LICENSE.txt for more details
 """
 
+from collections import defaultdict
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
 import sqlalchemy as sa
+from sqlalchemy.engine.default import DefaultDialect
 from sqlalchemy.sql import text
 from sqlalchemy.schema import Column, Table
 import sqlalchemy.sql.expression as sax
 import sqlalchemy.sql.functions as saf
 
+import numpy as np
+
+from alluvialflow.alluvialflow import FlowDataSource, FlowArrays, AlluvialFlowLayout
+
 # ===========
 # = Helpers =
 # ===========
@@ -30,43 +41,114 @@ def sql(expr):
     return ' '.join([sql(v) for v in expr])
   return str(expr)
 
+# A typed array that values can be appended to. Allocated at its initial 
+# capacity, and grows geometrically beyond it.
+class ArrayBuffer:
+  def __init__(self, dtype, capacity=1024):
+    self.buffer = np.empty(max(capacity, 1), dtype=dtype)
+    self.size = 0
+  
+  def extend(self, values):
+    end = self.size + len(values)
+    if end > len(self.buffer):
+      buffer = np.empty(max(end, 2 * len(self.buffer)), dtype=self.buffer.dtype)
+      buffer[:self.size] = self.buffer[:self.size]
+      self.buffer = buffer
+    self.buffer[self.size:end] = values
+    self.size = end
+  
+  # Returns the values as an array of their exact size, and releases the 
+  # buffer. Copies unless the buffer is exactly full.
+  def values(self):
+    values = self.buffer if self.size==len(self.buffer) else self.buffer[:self.size].copy()
+    self.buffer = values
+    return values
+
+# Assigns integer codes to labels in order of first appearance.
+class LabelCoder:
+  def __init__(self):
+    self.codes = dict() # label -> code
+    self.labels = []
+  
+  def encode(self, values):
+    value_idx, uniques = pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=False)
+    codes = np.empty(len(uniques), dtype=int)
+    for idx, value in enumerate(uniques):
+      code = self.codes.get(value)
+      if code is None:
+        code = self.codes[value] = len(self.labels)
+        self.labels.append(value)
+      codes[idx] = code
+    return codes[value_idx]
+  
+  # Returns an array that maps codes to positions in a list of labels, -1 if missing.
+  def remap(self, labels):
+    positions = dict(zip(labels, range(len(labels))))
+    return np.array([positions.get(label, -1) for label in self.labels] + [-1], dtype=int)
+
 # =======================
 # = SQL query fragments =
 # =======================
 
+# Renders named ":name" parameters, for use in text() statements.
+def named_dialect(engine=None):
+  if engine is None:
+    return DefaultDialect(paramstyle='named')
+  return type(engine.dialect)(paramstyle='named')
+
+# Base class for fragments. 
+# Fragments produce SQLAlchemy expressions with bound parameters for all values. 
+# Compose clause() into SQLAlchemy statements: SQLAlchemy caches compiled 
+# statements by structure, so statements with fragments that only differ in 
+# their values are compiled once. Whether the database also reuses query plans 
+# depends on the driver: it needs server-side prepared statements (e.g. 
+# psycopg 3, which prepares after prepare_threshold executions, or asyncpg). 
+# psycopg2 interpolates parameters on the client.
+class Fragment:
+  
+  # Returns an SQLAlchemy expression. 
+  # bind: a function that turns a value into a bind parameter
+  def _clause(self, bind):
+    raise Exception('Not implemented')
+  
+  # Returns an SQLAlchemy expression with anonymous bind parameters.
+  def clause(self):
+    return self._clause(lambda value: sa.bindparam(None, value, unique=True))
+  
+  # Returns an SQL string with inlined values.
+  def sql(self):
+    return sql(compile_expr(self.clause()))
+
 #
 # For node expressions
 #
 
-class Case:
+class Case(Fragment):
   class WhenExpr:
     def __init__(self, when_expr, value):
       self.when_expr = when_expr
       self.value = value
 
-    def _visit(self, expr):
-      return [
-        text('  WHEN'),
-        self.when_expr._visit(expr), 
-        text('THEN :value\n').bindparams(value=self.value)]
+    def _visit(self, expr, bind):
+      return (self.when_expr._visit(expr, bind), bind(self.value))
 
   def __init__(self, expr, *when_expr_list):
     self.expr = expr
-    self.when_expr_list = when_expr_list
+    self.when_expr_list = [e for e in when_expr_list if not isinstance(e, Else)]
+    self.else_expr = ([e for e in when_expr_list if isinstance(e, Else)] or [None])[-1]
 
-  def sql(self):
-    return sql(compile_expr([
-        text('CASE\n'),
-        [e._visit(self.expr) for e in self.when_expr_list],
-        text('END\n'),
-      ]))
+  def _clause(self, bind):
+    whens = [e._visit(self.expr, bind) for e in self.when_expr_list]
+    if self.else_expr is None:
+      return sa.case(*whens)
+    return sa.case(*whens, else_=self.else_expr._visit(self.expr, bind))
 
 class WhenAny:
   def __init__(self, *expr_list):
     self.expr_list = expr_list
 
-  def _visit(self, expr):
-    return sax.or_(*[e._visit(expr) for e in self.expr_list])
+  def _visit(self, expr, bind):
+    return sax.or_(*[e._visit(expr, bind) for e in self.expr_list])
   
   def Then(self, value):
     return Case.WhenExpr(self, value)
@@ -75,68 +157,408 @@ class Like:
   def __init__(self, value):
     self.value = value
 
-  def _visit(self, expr):
-    return expr.like(self.value)
+  def _visit(self, expr, bind):
+    return expr.like(bind(self.value))
 
 class Equal:
   def __init__(self, value):
     self.value = value
 
-  def _visit(self, expr):
-    return expr == self.value
+  def _visit(self, expr, bind):
+    return expr == bind(self.value)
 
 class Else:
   def __init__(self, value):
     self.value = value
 
-  def _visit(self, expr):
-    return text('ELSE :value\n').bindparams(value=self.value)
+  def _visit(self, expr, bind):
+    return bind(self.value)
 
 #
 # For rank expressions
 #
 
-class Sum:
+class Sum(Fragment):
   def __init__(self, expr):
     self.expr = expr
 
-  def sql(self):
-    return sql(compile_expr([
-        saf.sum(self.expr)
-      ]))
+  def _clause(self, bind):
+    return saf.sum(self.expr)
 
-class Count:
+class Count(Fragment):
   def __init__(self, expr):
     self.expr = expr
 
-  def sql(self):
-    return sql(compile_expr([
-        saf.count(self.expr)
-      ]))
+  def _clause(self, bind):
+    return saf.count(self.expr)
 
-class CountUnique:
+class CountUnique(Fragment):
   def __init__(self, expr):
     self.expr = expr
 
-  def sql(self):
-    return sql(compile_expr([
-        saf.count(sax.distinct(self.expr))
-      ]))
+  def _clause(self, bind):
+    return saf.count(sax.distinct(self.expr))
 
-class Min:
+class Min(Fragment):
   def __init__(self, expr):
     self.expr = expr
 
-  def sql(self):
-    return sql(compile_expr([
-        saf.min(self.expr)
-      ]))
+  def _clause(self, bind):
+    return saf.min(self.expr)
 
-class Max:
+class Max(Fragment):
   def __init__(self, expr):
     self.expr = expr
 
-  def sql(self):
-    return sql(compile_expr([
-        saf.max(self.expr)
-      ]))
\ No newline at end of file
+  def _clause(self, bind):
+    return saf.max(self.expr)
+
+# ===================
+# = SQL data source =
+# ===================
+
+# A FlowDataSource backed by a pooled SQLAlchemy engine.
+# Subclasses provide the three queries. get_all() issues them concurrently on 
+# separate pooled connections, so loading a layout takes as long as the slowest 
+# query rather than the sum of all three.
+#
+# Queries are SQL strings with ":name" parameters, or SQLAlchemy selectables.
+class SQLFlowDataSource(FlowDataSource):
+  # engine: an SQLAlchemy engine, or a database URL
+  # params: a dict of query parameters
+  # batch_size: number of rows per fetch when streaming results
+  # engine_args: additional create_engine arguments when engine is a URL
+  def __init__(self, engine, params=None, batch_size=10000, **engine_args):
+    if isinstance(engine, str):
+      engine = sa.create_engine(engine, **engine_args)
+    self.engine = engine
+    self.params = params or dict()
+    self.batch_size = batch_size
+  
+  # Returns a query for a list of nodes, with a "node" column
+  def get_nodes_query(self):
+    raise Exception('Not implemented')
+  
+  # Returns a query with step, node, size columns
+  def get_sequence_query(self):
+    raise Exception('Not implemented')
+  
+  # Returns a query with step1, node1, step2, node2, size columns
+  def get_flows_query(self):
+    raise Exception('Not implemented')
+  
+  # Returns an estimate of the number of rows of the sequence query, e.g. from 
+  # a COUNT(*) or table statistics, or None. Used to preallocate buffers in 
+  # get_flow_arrays().
+  def get_sequence_rows(self):
+    return None
+  
+  # Returns an estimate of the number of rows of the flows query, or None.
+  def get_flows_rows(self):
+    return None
+  
+  # Returns an ordered list of node names from the node query result.
+  def nodes_from_frame(self, d):
+    return list(d.node.values)
+  
+  def read_sql(self, query):
+    if isinstance(query, str):
+      query = text(query)
+    with self.engine.connect() as connection:
+      return pd.read_sql(query, connection, params=self.params)
+  
+  # Fetches a query result in batches through a server-side cursor, where 
+  # the database driver supports it. Label columns are decoded into integer 
+  # codes, and the value column into a float array, as rows arrive.
+  # rows: estimated number of rows, to allocate buffers once. Defaults to the 
+  #   batch size.
+  # Returns (list of code arrays, value array)
+  def stream_sql(self, query, coders, value_column, rows=None):
+    if isinstance(query, str):
+      query = text(query)
+    capacity = rows or self.batch_size
+    codes = [ArrayBuffer(int, capacity) for coder in coders]
+    values = ArrayBuffer(float, capacity)
+    with self.engine.connect() as connection:
+      result = connection.execution_options(
+        stream_results=True, max_row_buffer=self.batch_size).execute(query, self.params)
+      columns = list(result.keys())
+      label_idx = [columns.index(column) for column, coder in coders]
+      value_idx = columns.index(value_column)
+      for rows in result.partitions(self.batch_size):
+        batch = list(zip(*rows))
+        for buffer, (column, coder), idx in zip(codes, coders, label_idx):
+          buffer.extend(coder.encode(batch[idx]))
+        values.extend(np.asarray(batch[value_idx], dtype=float))
+    return [buffer.values() for buffer in codes], values.values()
+  
+  def get_nodes(self):
+    return self.nodes_from_frame(self.read_sql(self.get_nodes_query()))
+  
+  def get_sequence(self): 
+    d = self.read_sql(self.get_sequence_query())
+    return d.set_index(['step', 'node'])
+  
+  def get_flows(self): 
+    d = self.read_sql(self.get_flows_query())
+    return d.set_index(['step1', 'node1', 'step2', 'node2'])
+  
+  def get_all(self):
+    with ThreadPoolExecutor(max_workers=3) as executor:
+      nodes = executor.submit(self.get_nodes)
+      sequence = executor.submit(self.get_sequence)
+      flows = executor.submit(self.get_flows)
+      return nodes.result(), sequence.result(), flows.result()
+  
+  # Streams the sequence and flows straight into FlowArrays, without building 
+  # DataFrames. With accurate row estimates (get_sequence_rows, get_flows_rows), 
+  # each buffer is allocated once at its final size. Otherwise buffers grow 
+  # by doubling, so while one grows, its old and new copies coexist, and peak 
+  # memory can reach about twice the final arrays.
+  def get_flow_arrays(self):
+    seq_steps, seq_nodes = LabelCoder(), LabelCoder()
+    flow_steps, flow_nodes = LabelCoder(), LabelCoder()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+      nodes = executor.submit(self.get_nodes)
+      sequence = executor.submit(self.stream_sql, self.get_sequence_query(), 
+        [('step', seq_steps), ('node', seq_nodes)], 'size', self.get_sequence_rows())
+      flows = executor.submit(self.stream_sql, self.get_flows_query(), 
+        [('step1', flow_steps), ('node1', flow_nodes), 
+         ('step2', flow_steps), ('node2', flow_nodes)], 'size', self.get_flows_rows())
+      nodes = nodes.result()
+      (seq_step, seq_node), seq_size = sequence.result()
+      (flow_step1, flow_node1, flow_step2, flow_node2), flow_size = flows.result()
+    
+    # label codes -> step/node positions
+    steps = sorted(seq_steps.labels)
+    seq_step_pos, flow_step_pos = seq_steps.remap(steps), flow_steps.remap(steps)
+    seq_node_pos, flow_node_pos = seq_nodes.remap(nodes), flow_nodes.remap(nodes)
+    return FlowArrays.from_codes(nodes, steps, 
+      seq_step_pos[seq_step], seq_node_pos[seq_node], seq_size, 
+      flow_step_pos[flow_step1], flow_node_pos[flow_node1], 
+      flow_step_pos[flow_step2], flow_node_pos[flow_node2], flow_size)
+
+# ==============
+# = SQL layout =
+# ==============
+
+# An AlluvialFlowLayout that is computed by the database. Port positions are 
+# running sums over the node order within each step pair, and edge positions 
+# are running sums within each port, so both are window functions. 
+# Python only receives the final node port and edge coordinates.
+#
+# Requires window functions and CTEs (e.g. PostgreSQL, SQLite 3.25+).
+#
+# flow_data_source: an SQLFlowDataSource instance
+# scale_expr: an SQL expression template for scaling sizes, e.g. 'sqrt(%s)'
+# compact: adjust vertical node spacing to current flow sizes? Otherwise keep it constant throughout.
+class SQLFlowLayout(AlluvialFlowLayout):
+  def __init__(self, flow_data_source, 
+         node_margin=50, node_width=0.02,
+         scale_expr='%s',
+         compact=True,
+         show_stationary_component=True):
+    self.flow_data_source = flow_data_source
+    self.node_margin = node_margin
+    self.node_width = node_width
+    self.scale_expr = scale_expr
+    self.compact = compact
+    self.show_stationary_component = show_stationary_component
+    self.__layout()
+  
+  # Recomputes the layout with new parameters.
+  # params: any of node_margin, node_width, scale_expr, compact, show_stationary_component
+  def relayout(self, **params):
+    for name, value in params.items():
+      if name not in ('node_margin', 'node_width', 'scale_expr', 
+                      'compact', 'show_stationary_component'):
+        raise TypeError('Unknown layout parameter: %s' % name)
+      setattr(self, name, value)
+    self.__layout()
+    return self
+  
+  # Returns the SQL text of a data source query, for use in the layout CTEs. 
+  # Values bound in SQLAlchemy statements are added to params, with a name 
+  # prefix so that the anonymous parameters of different queries can't clash.
+  def __query_sql(self, query, prefix, params):
+    if isinstance(query, str):
+      return query
+    source_params = self.flow_data_source.params
+    compiled = query.compile(dialect=named_dialect(self.flow_data_source.engine))
+    bound = set(name for name in compiled.params if name not in source_params)
+    for name in bound:
+      params[prefix + name] = compiled.params[name]
+    return re.sub(r'(?<!:):(\w+)', 
+      lambda m: ':' + (prefix + m.group(1) if m.group(1) in bound else m.group(1)), 
+      str(compiled))
+  
+  # Common table expressions for the layout queries.
+  # num_nodes: the number of nodes, each bound as :layout_node_<rank>
+  # params: query parameters, to add values bound in the data source queries to
+  def __cte(self, num_nodes, params):
+    scale = lambda expr: self.scale_expr % expr
+    if self.show_stationary_component:
+      height = 'q.size' # "in"/"out" flow
+    else:
+      height = 'COALESCE(fs.size, 0)'
+    block = 'height' if self.compact else 'maxsize'
+    return """
+      WITH layout_seq_src AS (
+        %(sequence_query)s
+      ),
+      layout_flows_src AS (
+        %(flows_query)s
+      ),
+      layout_nodes(node, node_rank) AS (
+        VALUES %(node_values)s
+      ),
+      layout_sides(side) AS (
+        VALUES (0), (1)
+      ),
+      layout_steps AS (
+        SELECT step, ROW_NUMBER() OVER (ORDER BY step) - 1 AS step_idx
+        FROM (SELECT DISTINCT step FROM layout_seq_src) s
+      ),
+      layout_pairs AS (
+        SELECT step_idx AS pair_idx FROM layout_steps
+        WHERE step_idx < (SELECT MAX(step_idx) FROM layout_steps)
+      ),
+      layout_seq AS (
+        SELECT st.step_idx, n.node_rank, %(seq_size)s AS size
+        FROM layout_seq_src q
+        JOIN layout_steps st ON (st.step=q.step)
+        JOIN layout_nodes n ON (n.node=q.node)
+      ),
+      layout_maxsize AS (
+        SELECT n.node_rank, COALESCE(MAX(q.size), 0) AS size
+        FROM layout_nodes n
+        LEFT JOIN layout_seq q ON (q.node_rank=n.node_rank)
+        GROUP BY n.node_rank
+      ),
+      layout_flw AS (
+        SELECT s1.step_idx AS pair_idx, n1.node_rank AS rank1, n2.node_rank AS rank2, 
+          %(flow_size)s AS size
+        FROM layout_flows_src f
+        JOIN layout_steps s1 ON (s1.step=f.step1)
+        JOIN layout_steps s2 ON (s2.step=f.step2)
+        JOIN layout_nodes n1 ON (n1.node=f.node1)
+        JOIN layout_nodes n2 ON (n2.node=f.node2)
+        WHERE s2.step_idx = s1.step_idx + 1
+      ),
+      layout_flow_sums AS (
+        SELECT pair_idx, 0 AS side, rank1 AS node_rank, SUM(size) AS size 
+        FROM layout_flw GROUP BY pair_idx, rank1
+        UNION ALL
+        SELECT pair_idx, 1 AS side, rank2 AS node_rank, SUM(size) AS size 
+        FROM layout_flw GROUP BY pair_idx, rank2
+      ),
+      layout_ports AS (
+        SELECT p.pair_idx, sd.side, n.node_rank, m.size AS maxsize,
+          CASE WHEN q.size IS NULL THEN 0 ELSE 1 END AS present,
+          CASE WHEN q.size IS NULL THEN 0 ELSE %(height)s END AS height
+        FROM layout_pairs p
+        CROSS JOIN layout_sides sd
+        CROSS JOIN layout_nodes n
+        JOIN layout_maxsize m ON (m.node_rank=n.node_rank)
+        LEFT JOIN layout_seq q ON (q.step_idx=p.pair_idx + sd.side AND q.node_rank=n.node_rank)
+        LEFT JOIN layout_flow_sums fs ON (fs.pair_idx=p.pair_idx AND fs.side=sd.side AND fs.node_rank=n.node_rank)
+      ),
+      layout_port_layout AS (
+        SELECT pair_idx, side, node_rank, present, height, maxsize,
+          SUM(%(block)s + CAST(:layout_node_margin AS FLOAT)) OVER (
+            PARTITION BY pair_idx, side ORDER BY node_rank) AS y_end
+        FROM layout_ports
+      )
+      """ % {
+        'sequence_query': self.__query_sql(
+          self.flow_data_source.get_sequence_query(), 'layout_seq_', params),
+        'flows_query': self.__query_sql(
+          self.flow_data_source.get_flows_query(), 'layout_flows_', params),
+        'node_values': ', '.join(['(:layout_node_%d, %d)' % (rank, rank) for rank in range(num_nodes)]),
+        'seq_size': scale('q.size'),
+        'flow_size': scale('f.size'),
+        'height': height,
+        'block': block,
+      }
+  
+  # Returns one statement for steps, ports and edges, so the inputs and the 
+  # flow CTEs are evaluated once (multiply-referenced CTEs are materialised). 
+  # Rows are distinguished by kind: 0 = step, 1 = port, 2 = edge.
+  #   steps: idx, step
+  #   ports: idx (step pair), side, rank1 (node), size (max size), y_end, y1, y2
+  #   edges: idx (step pair), rank1, rank2, size, y1, y2
+  def __query(self, num_nodes, params):
+    block = 'height' if self.compact else 'maxsize'
+    return self.__cte(num_nodes, params) + """
+      , layout_edge_offsets AS (
+        SELECT pair_idx, rank1, rank2, size,
+          SUM(size) OVER (PARTITION BY pair_idx, rank1 ORDER BY rank2) - size AS offset1,
+          SUM(size) OVER (PARTITION BY pair_idx, rank2 ORDER BY rank1) - size AS offset2
+        FROM layout_flw
+      )
+      SELECT 0 AS kind, step_idx AS idx, step, 
+        NULL AS side, NULL AS rank1, NULL AS rank2, NULL AS size, 
+        NULL AS y_end, NULL AS y1, NULL AS y2
+      FROM layout_steps
+      UNION ALL
+      SELECT 1, pair_idx, NULL, side, node_rank, NULL, maxsize, y_end, 
+        y_end - (%(block)s + CAST(:layout_node_margin AS FLOAT)),
+        y_end - (%(block)s + CAST(:layout_node_margin AS FLOAT)) + height
+      FROM layout_port_layout
+      UNION ALL
+      SELECT 2, e.pair_idx, NULL, NULL, e.rank1, e.rank2, e.size, NULL,
+        CASE WHEN src.present=1 THEN src.y_end - (src.%(block)s + CAST(:layout_node_margin AS FLOAT)) + e.offset1 + e.size / 2.0 END,
+        CASE WHEN dst.present=1 THEN dst.y_end - (dst.%(block)s + CAST(:layout_node_margin AS FLOAT)) + e.offset2 + e.size / 2.0 END
+      FROM layout_edge_offsets e
+      JOIN layout_port_layout src ON (src.pair_idx=e.pair_idx AND src.side=0 AND src.node_rank=e.rank1)
+      JOIN layout_port_layout dst ON (dst.pair_idx=e.pair_idx AND dst.side=1 AND dst.node_rank=e.rank2)
+      """ % {'block': block}
+  
+  def __layout(self):
+    nodes = self.flow_data_source.get_nodes()
+    params = dict(self.flow_data_source.params)
+    params['layout_node_margin'] = self.node_margin
+    for rank, node in enumerate(nodes):
+      params['layout_node_%d' % rank] = node
+    
+    with self.flow_data_source.engine.connect() as connection:
+      rows = pd.read_sql(text(self.__query(len(nodes), params)), connection, params=params)
+    steps = rows[rows.kind==0].sort_values('idx')
+    ports = rows[rows.kind==1]
+    edges = rows[rows.kind==2].sort_values(['idx', 'rank1', 'rank2'])
+    
+    self.nodes = nodes
+    self.steps = steps.step.tolist()
+    
+    self.minx = 0
+    self.maxx = len(self.steps) - 1 + 0.3
+    self.miny = 0
+    self.maxy = max([0] + ports.y_end.astype(float).tolist())
+    
+    # step -> x
+    self.step_x = dict(zip(self.steps, range(len(self.steps))))
+    
+    # step pair -> node -> y1/y2
+    shape = (max(len(self.steps) - 1, 0), len(nodes))
+    self.src_y1, self.src_y2, self.dst_y1, self.dst_y2 = [np.zeros(shape) for i in range(4)]
+    for side, port_y1, port_y2 in [(0, self.src_y1, self.src_y2), (1, self.dst_y1, self.dst_y2)]:
+      d = ports[ports.side==side]
+      pair_idx, node_rank = d.idx.values.astype(int), d.rank1.values.astype(int)
+      port_y1[pair_idx, node_rank] = d.y1.values.astype(float)
+      port_y2[pair_idx, node_rank] = d.y2.values.astype(float)
+    
+    # node -> size
+    if self.compact==False:
+      self.node_maxsize = defaultdict(lambda: 0, 
+        zip([nodes[rank] for rank in ports.rank1.values.astype(int)], ports['size'].astype(float).tolist()))
+    
+    # edge -> y-centre, NaN for unplaced edges
+    self.flow_step = edges.idx.values.astype(int)
+    self.flow_node1 = edges.rank1.values.astype(int)
+    self.flow_node2 = edges.rank2.values.astype(int)
+    self.edge_width = edges['size'].values.astype(float)
+    self.edge_y1 = edges.y1.values.astype(float)
+    self.edge_y2 = edges.y2.values.astype(float)
+    
+    # read step/node lookups from the arrays, no per-flow work
+    self.build_views()
@@ -0,0 +1,126 @@
+"""
+  alluvialflow.store
+  ~~~~~~~~~~~~~~~~~~
+
+  A flat file format for computed layouts. Layout files are memory-mapped when 
+  loaded, so many processes can share one copy in the page cache, and loading 
+  takes no time regardless of layout size.
+
+  :copyright: 2015 by Martin Dittus, martin@dekstop.de
+  :license: AGPL3, see LICENSE.txt for more details
+"""
+
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from alluvialflow.alluvialflow import AlluvialFlowLayout, edge_keys
+
+# ==========
+# = Format =
+# ==========
+
+# File layout:
+# - MAGIC
+# - header size, as little-endian uint64
+# - JSON header: nodes, steps, layout parameters, and the dtype, shape and 
+#   offset of each array
+# - arrays, each aligned to ALIGNMENT bytes
+MAGIC = b'ALFLOW01'
+ALIGNMENT = 64
+
+ARRAYS = [
+  # step pair -> node -> y1/y2, for source and destination ports
+  ('src_y1', '<f8'), ('src_y2', '<f8'), ('dst_y1', '<f8'), ('dst_y2', '<f8'),
+  # edges, ordered by step pair, node1, node2
+  ('flow_step', '<i8'), ('flow_node1', '<i8'), ('flow_node2', '<i8'),
+  ('edge_width', '<f8'), ('edge_y1', '<f8'), ('edge_y2', '<f8'),
+]
+# sorted edge keys, for edge lookups without a pass over the flows at load time
+EDGE_KEYS = ('edge_keys', '<i8')
+SCALARS = ['minx', 'maxx', 'miny', 'maxy', 'node_width', 'node_margin', 
+  'compact', 'show_stationary_component']
+
+def aligned(offset):
+  return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+# numpy scalars -> python values, for JSON
+def to_python(values):
+  return [value.item() if hasattr(value, 'item') else value for value in values]
+
+# Writes an AlluvialFlowLayout (or any layout with the same arrays) to a file.
+# Steps and nodes are stored as JSON; values that JSON can't represent (e.g. 
+# dates) are stored as strings.
+def save_layout(layout, path):
+  arrays = [(name, np.ascontiguousarray(getattr(layout, name), dtype=dtype)) 
+    for name, dtype in ARRAYS]
+  keys = edge_keys(layout.flow_step, layout.flow_node1, layout.flow_node2, len(layout.nodes))
+  arrays.append((EDGE_KEYS[0], np.ascontiguousarray(keys, dtype=EDGE_KEYS[1])))
+  header = {
+    'nodes': to_python(layout.nodes),
+    'steps': to_python(layout.steps),
+    'scalars': dict((name, to_python([getattr(layout, name)])[0]) for name in SCALARS),
+    'arrays': dict(),
+  }
+  offsets = []
+  offset = 0
+  for name, values in arrays:
+    header['arrays'][name] = {'dtype': values.dtype.str, 'shape': values.shape, 'offset': offset}
+    offsets.append(offset)
+    offset = aligned(offset + values.nbytes)
+  header = json.dumps(header, default=str).encode('utf-8')
+  data_start = aligned(len(MAGIC) + 8 + len(header))
+  
+  with open(path, 'wb') as f:
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', len(header)))
+    f.write(header)
+    for (name, values), offset in zip(arrays, offsets):
+      f.seek(data_start + offset)
+      f.write(values.tobytes())
+    f.truncate(aligned(f.tell()))
+
+# Memory-maps a layout file. Returns a StoredLayout that can be passed to 
+# AlluvialFlowDiagram. Arrays are read-only views of the file.
+def load_layout(path):
+  with open(path, 'rb') as f:
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  if buf[:len(MAGIC)] != MAGIC:
+    raise Exception('Not a layout file: %s' % path)
+  header_size, = struct.unpack('<Q', buf[len(MAGIC):len(MAGIC) + 8])
+  header_start = len(MAGIC) + 8
+  header = json.loads(buf[header_start:header_start + header_size].decode('utf-8'))
+  data_start = aligned(header_start + header_size)
+  arrays = dict()
+  for name, spec in header['arrays'].items():
+    shape = tuple(spec['shape'])
+    arrays[name] = np.frombuffer(buf, dtype=np.dtype(spec['dtype']), 
+      count=int(np.prod(shape)), offset=data_start + spec['offset']).reshape(shape)
+  return StoredLayout(header['nodes'], header['steps'], header['scalars'], arrays)
+
+# ==========
+# = Layout =
+# ==========
+
+# A layout loaded from a file. Has the same attributes as AlluvialFlowLayout, 
+# but its step/node lookups are views over the arrays rather than dicts.
+class StoredLayout(AlluvialFlowLayout):
+  def __init__(self, nodes, steps, scalars, arrays):
+    self.nodes = nodes
+    self.steps = steps
+    for name, value in scalars.items():
+      setattr(self, name, value)
+    for name, values in arrays.items():
+      setattr(self, name, values)
+    
+    # step -> x
+    self.step_x = dict(zip(steps, range(len(steps))))
+    
+    # files without stored keys compute them
+    self.build_views(arrays.get(EDGE_KEYS[0]))
+  
+  # Stored layouts don't keep their input data, so they can't be recomputed.
+  def relayout(self, **params):
+    raise Exception('Stored layouts are read-only; compute a new layout and save it instead')
@@ -0,0 +1,73 @@
+"""
+  alluvialflow.window
+  ~~~~~~~~~~~~~~~~~~~
+
+  Step-range windows over a stored full-history flow model.
+
+  :copyright: 2015 by Martin Dittus, martin@dekstop.de
+  :license: AGPL3, see LICENSE.txt for more details
+"""
+
+import numpy as np
+
+from alluvialflow.alluvialflow import StaticFlowDataSource, AlluvialFlowLayout
+
+# ==========
+# = Window =
+# ==========
+
+# Holds the full sequence and flows of a model, sorted by step position, with an 
+# index of row offsets per step and per step pair. Windows over a contiguous 
+# step range are slices of these, so their cost depends on the window size 
+# rather than the length of the history.
+class WindowedFlowStore:
+  # flow_data_source: a FlowDataSource instance with the full history
+  def __init__(self, flow_data_source):
+    self.nodes, sequence, flows = flow_data_source.get_all()
+    flows = flows.reset_index()
+    self.steps = sequence.index.levels[0] # already sorted
+    sequence = sequence.reset_index()
+    
+    # step -> row offset
+    step_pos = self.steps.get_indexer(sequence.step)
+    order = np.argsort(step_pos, kind='mergesort')
+    self.sequence = sequence.iloc[order].reset_index(drop=True)
+    self.sequence_offsets = np.searchsorted(step_pos[order], 
+      np.arange(len(self.steps) + 1), side='left')
+    
+    # step pair -> row offset, for flows between consecutive steps
+    step1_pos = self.steps.get_indexer(flows.step1)
+    step2_pos = self.steps.get_indexer(flows.step2)
+    valid = (step1_pos >= 0) & (step2_pos == step1_pos + 1)
+    flows, pair_pos = flows[valid], step1_pos[valid]
+    order = np.argsort(pair_pos, kind='mergesort')
+    self.flows = flows.iloc[order].reset_index(drop=True)
+    self.flow_offsets = np.searchsorted(pair_pos[order], 
+      np.arange(max(len(self.steps) - 1, 0) + 1), side='left')
+  
+  # Returns the (first, last) step positions of an inclusive step range.
+  # Range bounds don't need to be actual steps; None means unbounded.
+  def get_step_range(self, first_step=None, last_step=None):
+    first = 0 if first_step is None else \
+      self.steps.searchsorted(first_step, side='left')
+    last = len(self.steps) - 1 if last_step is None else \
+      self.steps.searchsorted(last_step, side='right') - 1
+    return first, last
+  
+  # Returns a FlowDataSource for an inclusive step range.
+  def get_window(self, first_step=None, last_step=None):
+    first, last = self.get_step_range(first_step, last_step)
+    if last < first:
+      raise Exception('Empty step range: %s to %s' % (first_step, last_step))
+    sequence = self.sequence.iloc[
+      self.sequence_offsets[first]:self.sequence_offsets[last + 1]]
+    flows = self.flows.iloc[
+      self.flow_offsets[first]:self.flow_offsets[last]]
+    return StaticFlowDataSource(self.nodes, 
+      sequence.set_index(['step', 'node']), 
+      flows.set_index(['step1', 'node1', 'step2', 'node2']))
+  
+  # Returns an AlluvialFlowLayout for an inclusive step range.
+  # layout_args: AlluvialFlowLayout parameters
+  def get_layout(self, first_step=None, last_step=None, **layout_args):
+    return AlluvialFlowLayout(self.get_window(first_step, last_step), **layout_args)
@@ -10,11 +10,7 @@
   :license: AGPL3, see LICENSE.txt for more details
 """
 
-from string import Template
-
-import psycopg2 as pg
-import pandas as pd
-import pandas.io.sql as psql
+import sqlalchemy as sa
 
 from alluvialflow import *
 from alluvialflow.sql import *
@@ -23,105 +19,101 @@ from alluvialflow.sql import *
 # = Model =
 # =========
 
+# Tables used by the queries.
+sessions = sa.table('user_hmp_session', 
+    sa.column('hot_project'), sa.column('first_date'), sa.column('last_date'), sa.column('uid'))
+projects = sa.table('hot_project_description', 
+    sa.column('hot_project'), sa.column('title'))
+
 # A parametrised query builder. Generates node-edge flows for user contribution sessions.
 #
-# The implementation involves two levels of template variable substitution:
-# - query fragments (SQL logic), using python string templates: "${my_var}"
-# - query parameters (SQL values), using psychopg2 parameter substitution: "%(my_var)s"
-class ProjectContributorFlows(FlowDataSource):
+# Queries are SQLAlchemy statements, composed from:
+# - query fragments (SQL logic): the node and rank expressions
+# - query parameters (SQL values), using SQLAlchemy bound parameters: ":my_var"
+#
+# Fragment values are bound parameters too, and SQLAlchemy caches compiled 
+# statements by structure, so queries for node expressions of the same shape 
+# are compiled once. To also reuse query plans on the server, use a driver with 
+# server-side prepared statements, e.g. psycopg 3 (postgresql+psycopg://), 
+# which prepares a statement once it has run prepare_threshold times.
+#
+# The three queries are issued concurrently on pooled connections.
+class ProjectContributorFlows(SQLFlowDataSource):
     
-    # connection: ...
+    # engine: an SQLAlchemy engine or database URL
     # first_date, last_date: ISO date strings
     # node_expr: a Case instance that produces a string identifier for each node
     # rank_expr: a Count, CountUnique, or Sum, ... instance that produces a rank order for each node
     # period_interval: a PostgreSQL interval string for step durations
     # period_format: a PostgreSQL date format string for step labels
-    def __init__(self, connection, first_date, last_date, 
+    def __init__(self, engine, first_date, last_date, 
                  node_expr, rank_expr=CountUnique(Column('uid')),
                  period_interval='1 month', period_format='YYYY-MM'):
-        self.connection = connection
-        self.expressions = {
-            'node_expr': node_expr.sql().replace('%', '%%'),
-            'rank_expr': rank_expr.sql().replace('%', '%%'),
-        }
-        self.params = {
+        SQLFlowDataSource.__init__(self, engine, params={
             'first_date': first_date, 
             'last_date': last_date,
             'period_interval': period_interval,
             'period_format': period_format,
-        }
+        })
+        self.node_expr = node_expr
+        self.rank_expr = rank_expr
     
+    # Sessions in the date range, joined with their project descriptions.
+    def sessions(self, *columns):
+        return sa.select(*columns) \
+            .select_from(sessions.join(projects, sessions.c.hot_project==projects.c.hot_project)) \
+            .where(sessions.c.first_date >= sa.cast(sa.bindparam('first_date'), sa.Date)) \
+            .where(sessions.c.last_date < sa.cast(sa.bindparam('last_date'), sa.Date))
+    
+    def step(self, date):
+        return sa.func.to_char(date, sa.bindparam('period_format'))
+    
+    def get_nodes_query(self):
+        node = self.node_expr.clause().label('node')
+        rank = self.rank_expr.clause()
+        return self.sessions(node, rank.label('rank')) \
+            .group_by('node') \
+            .order_by(rank.asc())
+
     # Returns an ordered list of node names, with 'Other' in first place, 
     # and the rest sorted in ascending order of rank.
-    def get_nodes(self):
-        sql = Template("""
-            SELECT 
-                ${node_expr} as node,
-                ${rank_expr} rank
-            FROM user_hmp_session s
-            JOIN hot_project_description p ON (s.hot_project=p.hot_project)
-            WHERE first_date >= %(first_date)s::date
-            AND last_date < %(last_date)s::date
-            GROUP BY node
-            ORDER BY ${rank_expr} ASC
-            """).substitute(self.expressions)
-        d = psql.read_sql(sql, self.connection, params=self.params)
+    def nodes_from_frame(self, d):
 #         d.sort('rank', ascending=False)
         nodes = list(d.node.values)
         nodes.remove('Other')
         nodes.insert(0, 'Other')
         return nodes
 
-    # returns a DataFrame[step, node; size]
-    def get_sequence(self): 
-        sql = Template("""
-            SELECT 
-                TO_CHAR(first_date, %(period_format)s) as step, 
-                ${node_expr} as node,
-                count(distinct uid) size
-            FROM user_hmp_session s
-            JOIN hot_project_description p ON (s.hot_project=p.hot_project)
-            WHERE first_date >= %(first_date)s::date
-            AND last_date < %(last_date)s::date
-            GROUP BY step, node
-            """).substitute(self.expressions)
-        d = psql.read_sql(sql, self.connection, params=self.params)
-        return d.set_index(['step', 'node'])
-
-    # returns a DataFrame[step1, node1, step2, node2; size]
-    def get_flows(self): 
-        sql = Template("""
-            WITH timeline AS (
-                SELECT
-                    TO_CHAR(first_date, 'YYYY-MM') as step, 
-                    ${node_expr} as node,
-                    uid
-                FROM user_hmp_session s
-                JOIN hot_project_description p ON (s.hot_project=p.hot_project)
-                WHERE first_date >= %(first_date)s::date
-                AND last_date < %(last_date)s::date
-                GROUP BY step, node, uid
-            )
-            SELECT 
-                t1.step step1, t1.node node1, 
-                t2.step step2, t2.node node2,
-                count(distinct t1.uid) size
-            FROM (
-                SELECT 
-                    TO_CHAR(s1,                                %(period_format)s) step1,
-                    TO_CHAR(s1 + interval %(period_interval)s, %(period_format)s) step2
-                FROM generate_Series(
-                    %(first_date)s::date, 
-                    %(last_date)s::date - %(period_interval)s::interval, 
-                    %(period_interval)s::interval) s1
-            ) t
-            JOIN timeline t1 ON (step1=t1.step)
-            JOIN timeline t2 ON (step2=t2.step)
-            WHERE t1.uid=t2.uid
-            GROUP BY t1.step, t1.node, t2.step, t2.node
-            """).substitute(self.expressions)
-        d = psql.read_sql(sql, self.connection, params=self.params)
-        return d.set_index(['step1', 'node1', 'step2', 'node2'])
+    def get_sequence_query(self): 
+        step = self.step(sessions.c.first_date).label('step')
+        node = self.node_expr.clause().label('node')
+        return self.sessions(step, node, 
+                sa.func.count(sa.distinct(sessions.c.uid)).label('size')) \
+            .group_by('step', 'node')
+
+    def get_flows_query(self): 
+        step = self.step(sessions.c.first_date).label('step')
+        node = self.node_expr.clause().label('node')
+        timeline = self.sessions(step, node, sessions.c.uid) \
+            .group_by('step', 'node', sessions.c.uid) \
+            .cte('timeline')
+        interval = sa.cast(sa.bindparam('period_interval'), sa.Interval)
+        s1 = sa.func.generate_series(
+            sa.cast(sa.bindparam('first_date'), sa.Date), 
+            sa.cast(sa.bindparam('last_date'), sa.Date) - interval, 
+            interval).column_valued('s1')
+        t = sa.select(self.step(s1).label('step1'), self.step(s1 + interval).label('step2')) \
+            .subquery('t')
+        t1, t2 = timeline.alias('t1'), timeline.alias('t2')
+        return sa.select(
+                t1.c.step.label('step1'), t1.c.node.label('node1'), 
+                t2.c.step.label('step2'), t2.c.node.label('node2'),
+                sa.func.count(sa.distinct(t1.c.uid)).label('size')) \
+            .select_from(t
+                .join(t1, t.c.step1==t1.c.step)
+                .join(t2, t.c.step2==t2.c.step)) \
+            .where(t1.c.uid==t2.c.uid) \
+            .group_by(t1.c.step, t1.c.node, t2.c.step, t2.c.node)
 
 # ========
 # = Main =
@@ -129,7 +121,7 @@ class ProjectContributorFlows(FlowDataSource):
 
 if __name__=="__main__":
 
-  connection = pg.connect("dbname=hotosm_history_20150813 user=osm host=localhost")
+  engine = "postgresql+psycopg://osm@localhost/hotosm_history_20150813"
 
   first_date = '2013-08-01'
   last_date = '2015-08-01'
@@ -144,7 +136,7 @@ if __name__=="__main__":
       WhenAny(Like('%MapLesotho%')).Then('MapLesotho'),
       Else('Other'))
 
-  data = ProjectContributorFlows(connection, first_date, last_date, top_node_types)
+  data = ProjectContributorFlows(engine, first_date, last_date, top_node_types)
   layout = AlluvialFlowLayout(data, node_margin=50, node_width=0.02, compact=True)
   diagram = AlluvialFlowDiagram(layout)
   fig = diagram.plot(size=(58,18), style=SimpleStyle(showlegend=False), 
@@ -8,9 +8,12 @@ setup(
     'matplotlib',
     'numpy',
     'pandas',
-    'psycopg2',
+    'psycopg',
     'sqlalchemy',
   ],
+  extras_require = {
+    'parquet': ['pyarrow'],
+  },
   version = "0.1.0",
   description = "Alluvial flow visualisations in Python",
   author = "Martin Dittus",